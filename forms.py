@@ -2,10 +2,12 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 
+from datetime import date, datetime
 from django import forms
+from django.forms.formsets import BaseFormSet, formset_factory
 from django.contrib.admin import widgets
 from rapidsms.models import *
-from retail.models import Sale, Stock, Product
+from retail.models import Sale, Stock, Product, ExportJob, ImportJob
 
 
 class ContactForm(forms.ModelForm):
@@ -18,9 +20,7 @@ class SaleForm(forms.ModelForm):
         cleaned_data = self.cleaned_data
         serial = cleaned_data.get("serial")
         code = serial[0:2].upper()
-        try:
-            prod = Product.objects.get(code=code)
-        except:
+        if Product.by_code(code) is None:
             raise forms.ValidationError("Product code %s not found" % code)
         #exists = Sale.objects.filter(serial=serial)
         #if exists:
@@ -33,7 +33,7 @@ class SaleForm(forms.ModelForm):
         
         code = cleaned_data.get("serial")[0:2].upper()
         current_stock = Stock.get_existing(cleaned_data.get("seller").alias, code)
-        prod = Product.objects.get(code=code)
+        prod = Product.by_code(code)
         if current_stock is None or current_stock.stock_amount <= 0:
             raise forms.ValidationError("%s has no %s in stock" % (cleaned_data.get("seller").alias, prod.display_name))
         return cleaned_data["seller"]
@@ -45,3 +45,104 @@ class SaleForm(forms.ModelForm):
         }
         exclude = ("product")
 
+class SaleRowForm(forms.Form):
+    """
+    One row of the sale entry grid. The seller's choices are set by the
+    formset, and stock and registered serials are checked by it for all
+    the rows at once.
+    """
+    serial = Sale._meta.get_field('serial').formfield()
+    seller = forms.ChoiceField()
+    fname = Sale._meta.get_field('fname').formfield()
+    lname = Sale._meta.get_field('lname').formfield()
+    pri_phone = Sale._meta.get_field('pri_phone').formfield()
+    purchase_price = Sale._meta.get_field('purchase_price').formfield()
+    region = Sale._meta.get_field('region').formfield()
+    description = Sale._meta.get_field('description').formfield()
+    purchase_date = forms.DateField(initial=date.today)
+
+    def has_changed(self):
+        #rows are sent with today's date filled in, so only the other
+        #fields tell whether a row was used
+        return any(self.data.get(self.add_prefix(name)) for name in self.fields if name != 'purchase_date')
+
+    def clean_serial(self):
+        serial = self.cleaned_data["serial"].upper()
+        code = serial[0:2]
+        if Product.by_code(code) is None:
+            raise forms.ValidationError("Product code %s not found" % code)
+        return serial
+
+class BaseSaleGridFormSet(BaseFormSet):
+    """
+    Rows of sales for the sellers in ``sellers``, validated together. Once
+    valid, ``sales`` holds the Sale of each row that was filled in.
+    """
+
+    def __init__(self, sellers, *args, **kwargs):
+        self.seller_list = sellers
+        self.sellers = dict((str(c.pk), c) for c in sellers)
+        self.seller_choices = [("", "---------")] + [(str(c.pk), c.alias) for c in sellers]
+        self.sales = []
+        super(BaseSaleGridFormSet, self).__init__(*args, **kwargs)
+
+    def add_fields(self, form, index):
+        super(BaseSaleGridFormSet, self).add_fields(form, index)
+        form.fields['seller'].choices = self.seller_choices
+
+    def clean(self):
+        if any(self.errors):
+            return
+        sales, rows = [], []
+        for form in self.forms:
+            data = form.cleaned_data
+            if not data:
+                continue
+            d = data['purchase_date']
+            sales.append(Sale(serial=data['serial'], seller=self.sellers[data['seller']],
+                              product=Product.by_code(data['serial'][0:2]),
+                              purchase_date=datetime(d.year, d.month, d.day), fname=data['fname'],
+                              lname=data['lname'], pri_phone=data['pri_phone'],
+                              purchase_price=data['purchase_price'], region=data['region'],
+                              description=data['description']))
+            rows.append(form)
+        if not sales:
+            raise forms.ValidationError("Enter at least one sale")
+        accepted, rejected = Sale.check_many(sales)
+        forms_by_sale = dict((id(sale), form) for sale, form in zip(sales, rows))
+        for sale, reason in rejected:
+            form = forms_by_sale[id(sale)]
+            if reason == "already registered":
+                form._errors['serial'] = form.error_class(["%s %s" % (sale.serial, reason)])
+            else:
+                form._errors['seller'] = form.error_class([reason])
+        if rejected:
+            raise forms.ValidationError("%d of the sales can't be saved, see below" % len(rejected))
+        self.sales = sales
+        self.sale_forms = rows
+
+    def without(self, saved):
+        """
+        A formset of the rows of this one whose sales aren't in ``saved``,
+        for redisplay after only some of the sales could be saved.
+        """
+        saved = set(id(sale) for sale in saved)
+        rows = [form for sale, form in zip(self.sales, self.sale_forms) if id(sale) not in saved]
+        data = {}
+        for i, form in enumerate(rows):
+            for name in form.fields:
+                data["%s-%d-%s" % (self.prefix, i, name)] = form.data.get(form.add_prefix(name))
+        data["%s-TOTAL_FORMS" % self.prefix] = str(max(len(rows), self.extra))
+        data["%s-INITIAL_FORMS" % self.prefix] = "0"
+        data["%s-MAX_NUM_FORMS" % self.prefix] = ""
+        return self.__class__(self.seller_list, data=data, prefix=self.prefix)
+
+SaleGridFormSet = formset_factory(SaleRowForm, formset=BaseSaleGridFormSet, extra=10)
+
+class ExportJobForm(forms.ModelForm):
+    class Meta:
+        model = ExportJob
+        fields = ("organization", "start_date", "end_date", "compressed")
+
+class ImportJobForm(forms.Form):
+    file = forms.FileField(help_text="CSV file with the columns of a sales export, and the retailer alias")
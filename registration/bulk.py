@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Bulk registration of contacts from CSV, one contact per row of name,
+alias, backend name and identity. Rows are checked a batch at a time,
+with one query for the aliases and one for the identities already taken,
+and each batch's contacts and connections are inserted a table at a
+time, so registering thousands of contacts takes a few dozen queries.
+"""
+
+import csv
+
+from rapidsms.models import Backend, Connection, Contact
+from retail import caching
+from retail.imports import decode
+from retail.models import insert_many
+
+BATCH_SIZE = 500
+
+COLUMNS = ("name", "alias", "backend", "identity")
+
+def register_contacts(lines, organization):
+    """
+    Register the contacts in the CSV ``lines`` to ``organization``, and
+    return how many were, and a (line number, row, error) for each row
+    that wasn't.
+    """
+    #the table of the fields Contact inherits, which has the ids
+    users = Contact._meta.get_field("alias").model
+    backends = dict((b.name, b) for b in Backend.objects.all())
+    #the first contact of an organization manages it, as with reg
+    has_manager = Contact.objects.filter(organization=organization).exists()
+    state = {"registered": 0, "errors": [], "has_manager": has_manager}
+
+    def register_batch(rows):
+        aliases = set(users.objects.filter(alias__in=[r[1] for n, r in rows if len(r) == len(COLUMNS)])
+                                   .values_list("alias", flat=True))
+        identities = set(Connection.objects.filter(identity__in=[r[3] for n, r in rows if len(r) == len(COLUMNS)])
+                                           .values_list("backend__name", "identity"))
+        contacts, connections = [], []
+        for number, row in rows:
+            error = check_row(row, backends, aliases, identities)
+            if error:
+                state["errors"].append((number, ", ".join(row), error))
+                continue
+            name, alias, backend, identity = row
+            aliases.add(alias)
+            identities.add((backend, identity))
+            contact = Contact(name=name, alias=alias, organization=organization,
+                              role=(not state["has_manager"]) and Contact.MANAGER or Contact.SELLER)
+            state["has_manager"] = True
+            contacts.append(contact)
+            connections.append(Connection(backend=backends[backend], identity=identity))
+        if not contacts:
+            return
+
+        insert_many(users, contacts)
+        ids = dict(users.objects.filter(alias__in=[c.alias for c in contacts]).values_list("alias", "id"))
+        for contact, connection in zip(contacts, connections):
+            contact.pk = ids[contact.alias]
+            connection.contact_id = contact.pk
+        insert_many(Contact, contacts)
+        insert_many(Connection, connections)
+        state["registered"] += len(contacts)
+
+    batch = []
+    for number, row in enumerate(csv.reader(lines)):
+        if not row or not "".join(row).strip():
+            continue
+        row = [decode(v) for v in row]
+        if len(row) == len(COLUMNS):
+            row[0] = " ".join(w.capitalize() for w in row[0].split())
+            row[1] = row[1].lower()
+        batch.append((number + 1, row))
+        if len(batch) == BATCH_SIZE:
+            register_batch(batch)
+            batch = []
+    register_batch(batch)
+    if state["registered"]:
+        caching.bump(organization.id)
+    return state["registered"], state["errors"]
+
+def check_row(row, backends, aliases, identities):
+    """
+    Why ``row`` can't be registered, or None if it can. ``aliases`` and
+    ``identities`` are those already taken.
+    """
+    if len(row) != len(COLUMNS):
+        return "expected %d columns (%s), found %d" % (len(COLUMNS), ", ".join(COLUMNS), len(row))
+    name, alias, backend, identity = row
+    if not name:
+        return "name is missing"
+    alias_field = Contact._meta.get_field("alias")
+    if not alias or " " in alias or len(alias) > alias_field.max_length:
+        return "alias must be 1 to %d characters, no spaces" % alias_field.max_length
+    if alias in aliases:
+        return "alias %s is already in use" % alias
+    if backend not in backends:
+        return "backend %s not found" % backend
+    if not identity:
+        return "identity is missing"
+    if (backend, identity) in identities:
+        return "%s is already registered" % identity
+    return None
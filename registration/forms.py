@@ -17,6 +17,6 @@ class BulkRegistrationForm(forms.Form):
     bulk = SmallFileField(
         label="Upload CSV file",
         required=False,
-        help_text="Upload a <em>plain text file</em> " +
+        help_text="Upload a <em>CSV file</em> " +
                   "containing a single contact per line, for example: <br/>" +
-                  "<em>firstname lastname, backend_name, identity</em>")
+                  "<em>firstname lastname, alias, backend_name, identity</em>")
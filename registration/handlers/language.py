@@ -2,18 +2,20 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 
-from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
+from retail.grammar import CommandHandler
 from rapidsms.models import Contact
 from rapidsms.conf import settings
+from retail.timing import timed
 
 
-class LanguageHandler(KeywordHandler):
+@timed
+class LanguageHandler(CommandHandler):
     """
     Allow remote users to set their preferred language, by updating the
     ``language`` field of the Contact associated with their connection.
     """
 
-    keyword = "language|lang"
+    command = "language"
 
     def help(self):
         self.respond("To set your language, send LANGUAGE <CODE>")
@@ -0,0 +1,83 @@
+"""
+Bulk registration of contacts from CSV, with the same query budgets and
+dataset as the retail tests.
+"""
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TransactionTestCase
+
+from rapidsms.models import Backend, Contact
+
+from registration.bulk import register_contacts
+from retail.models import Organization
+from retail.tests import QueryBudgetTestCase, BACKEND
+
+
+class BulkRegistrationTest(QueryBudgetTestCase):
+
+    def test_bulk_registration(self):
+        lines = ["ann bee, ab%d, %s, 07560%05d" % (i, BACKEND, i) for i in range(300)]
+        lines += ["Cee Dee, s1, %s, 0756099999" % BACKEND, "Cee Dee, cd, nowhere, 0756099999",
+                  "Cee Dee, cd, %s, 0755000001" % BACKEND, "Cee Dee, ab7, %s, 0756088888" % BACKEND,
+                  "Cee Dee, cd"]
+        #one batch costs the same whatever its size
+        registered, errors = self.assertMaxQueries(10, register_contacts, lines, self.org)
+        self.assertEqual(registered, 300)
+        self.assertEqual([(line, error) for line, row, error in errors],
+                         [(301, "alias s1 is already in use"), (302, "backend nowhere not found"),
+                          (303, "0755000001 is already registered"), (304, "alias ab7 is already in use"),
+                          (305, "expected 4 columns (name, alias, backend, identity), found 2")])
+        contact = Contact.objects.get(alias="ab7")
+        self.assertEqual((contact.name, contact.organization, contact.role), ("Ann Bee", self.org, 0))
+        self.assertEqual(contact.connection_set.get().identity, "0756000007")
+
+    def test_bulk_registration_page(self):
+        self.client.login(username="manager", password="secret")
+        f = SimpleUploadedFile("staff.csv", "Cee Dee, cd, %s, 0756099999\nEe Eff, s1, %s, 0756099998\n" % (BACKEND, BACKEND))
+        response = self.client.post("/registration/", {"bulk": f, "submit": "Save Contacts"})
+        self.assertEqual(response.context["bulk_registered"], 1)
+        self.assertContains(response, "alias s1 is already in use")
+        self.assertTrue(Contact.objects.filter(alias="cd", organization=self.org).exists())
+
+    def test_bulk_registration_windows_csv(self):
+        registered, errors = register_contacts(["Ren\xe9 Dee, rd, %s, 0756099997" % BACKEND], self.org)
+        self.assertEqual((registered, errors), (1, []))
+        self.assertEqual(Contact.objects.get(alias="rd").name, u"Ren\xe9 Dee")
+
+
+class BulkRegistrationCommitTest(TransactionTestCase):
+    """
+    Checks that what's registered is committed, by the page and when
+    there's no transaction being managed, which the transaction TestCase
+    wraps each test in would hide.
+    """
+
+    def setUp(self):
+        self.org = Organization.objects.create(code="ORG", display_name="Org", full_name="Org Full")
+        Backend.objects.get_or_create(name=BACKEND)
+        user = User.objects.create_user("manager", "manager@example.com", "secret")
+        profile = user.get_profile()
+        profile.organization = self.org
+        profile.save()
+
+    def tearDown(self):
+        #the rows are committed, and the test cases run after this one
+        #expect an empty database
+        call_command("flush", verbosity=0, interactive=False)
+
+    def test_bulk_registration_commits(self):
+        self.client.login(username="manager", password="secret")
+        f = SimpleUploadedFile("staff.csv", "Cee Dee, cd, %s, 0756099999\n" % BACKEND)
+        self.client.post("/registration/", {"bulk": f, "submit": "Save Contacts"})
+        #anything left uncommitted is lost when the connection closes
+        transaction.rollback()
+        contact = Contact.objects.get(alias="cd", organization=self.org)
+        self.assertEqual(contact.connection_set.get().identity, "0756099999")
+
+    def test_bulk_registration_outside_a_transaction(self):
+        register_contacts(["Cee Dee, cd, %s, 0756099999" % BACKEND], self.org)
+        transaction.rollback()
+        self.assertTrue(Contact.objects.filter(alias="cd", organization=self.org).exists())
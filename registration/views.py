@@ -1,8 +1,6 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
-import csv
-
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
@@ -11,17 +9,17 @@ from django.shortcuts import render_to_response, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from pikwa.forms import ContactForm
 from rapidsms.models import Contact
-from rapidsms.models import Connection
-from rapidsms.models import Backend
 from pikwa.retail.models import Sale, Stock
 from .tables import ContactTable
 from .forms import BulkRegistrationForm
+from .bulk import register_contacts
 
 @transaction.commit_on_success
 @login_required
 def registration(req, pk=None):
     contact = None
-    sellerSummary = None
+    bulk_form = BulkRegistrationForm()
+    registered, bulk_errors = 0, []
 
     if pk is not None:
         contact = get_object_or_404(
@@ -34,26 +32,17 @@ def registration(req, pk=None):
                 reverse(registration))
 
         elif "bulk" in req.FILES:
-            # TODO use csv module
-            #reader = csv.reader(open(req.FILES["bulk"].read(), "rb"))
-            #for row in reader:
-            for line in req.FILES["bulk"]:
-                line_list = line.split(',')
-                name = line_list[0].strip()
-                backend_name = line_list[1].strip()
-                identity = line_list[2].strip()
-
-                contact = Contact(name=name)
-                contact.save()
-                # TODO deal with errors!
-                backend = Backend.objects.get(name=backend_name)
-
-                connection = Connection(backend=backend, identity=identity,\
-                    contact=contact)
-                connection.save()
-
-            return HttpResponseRedirect(
-                reverse(registration))
+            org = req.user.get_profile().organization
+            if org is None:
+                bulk_errors = [(None, "", "contacts can only be registered to your organization, and you have none")]
+            else:
+                registered, bulk_errors = register_contacts(req.FILES["bulk"], org)
+            if not bulk_errors:
+                return HttpResponseRedirect(
+                    reverse(registration))
+            #show which rows weren't registered, and why
+            contact_form = ContactForm(
+                instance=contact)
         else:
             contact_form = ContactForm(
                 instance=contact,
@@ -72,8 +61,7 @@ def registration(req, pk=None):
             #organization to that of the logged in user
             #################
             #instance=Contact(organization=req.user.get_profile().organization))
-        seller_summary = getSellerSummary(contact)
-        bulk_form = BulkRegistrationForm()
+    seller_summary = getSellerSummary(contact)
 
     if req.user.is_staff:
         ctable = ContactTable(Contact.objects.exclude(alias='nobody'), request=req)
@@ -88,6 +76,8 @@ def registration(req, pk=None):
             "contacts_table": ctable,
             "contact_form": contact_form,
             "bulk_form": bulk_form,
+            "bulk_registered": registered,
+            "bulk_errors": bulk_errors,
             "contact": contact,
             "seller_summary": seller_summary
         }, context_instance=RequestContext(req)
@@ -1,9 +1,15 @@
-from .models import Product, Stock, Sale, StockTransaction, Organization, UserProfile
+from .models import Product, Stock, Sale, SaleRollup, SaleChange, StockTransaction, TransferLine, Organization, UserProfile, ExportJob, ImportJob, HandlerTiming
 from django.contrib import admin
 
 admin.site.register(Product)
 admin.site.register(Stock)
 admin.site.register(Sale)
+admin.site.register(SaleRollup)
+admin.site.register(SaleChange)
 admin.site.register(StockTransaction)
+admin.site.register(TransferLine)
 admin.site.register(Organization)
 admin.site.register(UserProfile)
+admin.site.register(ExportJob)
+admin.site.register(ImportJob)
+admin.site.register(HandlerTiming)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Caching for the dashboard figures. Each organization has a version
+counter which is bumped whenever its sales or stock change, and cached
+figures are stored under the current version, so a bump makes every
+entry for that organization unreachable at once. Versions are random
+rather than counted up, as incr isn't atomic on every backend (it's a
+get then a set on the file based one), and two bumps at once could
+otherwise both write the same new version. The staff dashboard
+uses its own version, which is bumped along with every organization's.
+
+The router and the web server run in separate processes, so a cache
+backend shared between them (eg. file based) is needed for the bumps
+to reach the dashboards. See CACHES in settings.py.
+"""
+
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+
+ALL = "all"
+
+#cached figures are dropped by version bumps, so they can live a long time
+TIMEOUT = getattr(settings, "RETAIL_DASHBOARD_CACHE_TIMEOUT", 24 * 60 * 60)
+VERSION_TIMEOUT = 30 * 24 * 60 * 60
+
+HITS_KEY = "retail:dashboard:hits"
+MISSES_KEY = "retail:dashboard:misses"
+
+def _version_key(scope):
+    return "retail:dashboard:version:%s" % scope
+
+def _incr(key, initial=0, timeout=None):
+    #only used for the hit and miss counts, which can afford to lose one
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, initial, timeout)
+        return cache.incr(key)
+
+def _bump_version(scope):
+    version = uuid.uuid4().hex
+    cache.set(_version_key(scope), version, VERSION_TIMEOUT)
+    return version
+
+def get_version(scope):
+    version = cache.get(_version_key(scope))
+    if version is None:
+        #whoever adds it first picks the version everyone uses
+        cache.add(_version_key(scope), uuid.uuid4().hex, VERSION_TIMEOUT)
+        version = cache.get(_version_key(scope))
+    return version
+
+def bump(*org_ids):
+    """
+    Invalidate the cached figures of each organization in ``org_ids``,
+    and of the staff dashboard.
+    """
+    for org_id in set(org_ids):
+        if org_id is not None:
+            _bump_version(org_id)
+    _bump_version(ALL)
+
+def get_or_build(scope, name, builder):
+    """
+    Return the figures cached as ``name`` for ``scope`` (an organization
+    id, or ALL), calling ``builder`` to compute and cache them on a miss.
+    """
+    key = "retail:dashboard:%s:%s:%s" % (scope, get_version(scope), name)
+    figures = cache.get(key)
+    if figures is not None:
+        _incr(HITS_KEY)
+        return figures
+    _incr(MISSES_KEY)
+    figures = builder()
+    cache.set(key, figures, TIMEOUT)
+    return figures
+
+def stats():
+    return {"hits": cache.get(HITS_KEY) or 0,
+            "misses": cache.get(MISSES_KEY) or 0}
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""
+Sales export, as a stream of CSV lines. Sales are read in fixed size
+chunks, each one continuing past the (purchase_date, serial) of the last
+row of the previous chunk, and only the exported columns are selected,
+so memory use doesn't grow with the number of sales exported.
+"""
+
+import csv
+import zlib
+from cStringIO import StringIO
+
+from django.db.models import Q
+from retail.models import Sale, SaleChange
+
+CHUNK_SIZE = 2000
+
+HEADER = ['Sale date', 'Retailer', 'Serial #', 'Last name', 'First name', 'Primary phone', 'Secondary phone', 'Region', 'Location notes']
+
+COLUMNS = ('purchase_date', 'seller__name', 'serial', 'lname', 'fname', 'pri_phone', 'sec_phone', 'region', 'description')
+
+def sale_rows(sales, chunk_size=CHUNK_SIZE):
+    """
+    Yield the export row of each sale in ``sales``, oldest first.
+    """
+    regions = dict(Sale.REGION_CHOICES)
+    sales = sales.order_by('purchase_date', 'serial').values_list(*COLUMNS)
+    last = None
+    while True:
+        chunk = sales
+        if last is not None:
+            #the bound on the date alone starts the index range scan at
+            #the last row, so each chunk costs the same
+            chunk = chunk.filter(purchase_date__gte=last[0])\
+                .filter(Q(purchase_date__gt=last[0]) | Q(serial__gt=last[1]))
+        count = 0
+        for row in chunk[:chunk_size].iterator():
+            yield _export_row(regions, *row)
+            last = (row[0], row[2])
+            count += 1
+        if count < chunk_size:
+            break
+
+CHANGE_HEADER = ['Change', 'Changed at'] + HEADER
+
+def _export_row(regions, date, seller, serial, lname, fname, pri_phone, sec_phone, region, description):
+    return [date.strftime("%Y-%m-%d"), seller or "Anonymous", serial, lname.capitalize(), fname.capitalize(),
+            pri_phone, sec_phone, regions.get(region, region), description]
+
+def snapshot_rows(sales, chunk_size=CHUNK_SIZE):
+    """
+    Yield every sale in ``sales`` as a change row, for a client starting
+    the incremental feed with no cursor.
+    """
+    for row in sale_rows(sales, chunk_size):
+        yield ['sale', ''] + row
+
+def change_rows(changes, chunk_size=CHUNK_SIZE):
+    """
+    Yield a row for each entry of the sale change log ``changes``, in
+    the order they were logged, reading the sales of each chunk in one
+    more query. Cancellations are tombstones holding only the serial. A
+    recorded sale whose link was cleared has since been canceled, and is
+    left out in favour of its tombstone.
+    """
+    regions = dict(Sale.REGION_CHOICES)
+    actions = dict(SaleChange.ACTION_CHOICES)
+    changes = changes.order_by('id').values_list('id', 'action', 'date', 'serial', 'sale')
+    last_id = 0
+    while True:
+        chunk = list(changes.filter(id__gt=last_id)[:chunk_size])
+        serials = [c[4] for c in chunk if c[4] is not None]
+        sales = {}
+        if serials:
+            for row in Sale.objects.filter(serial__in=serials).values_list(*COLUMNS).iterator():
+                sales[row[2]] = _export_row(regions, *row)
+        for change_id, action, changed_at, serial, sale in chunk:
+            changed_at = changed_at.strftime("%Y-%m-%d %H:%M:%S")
+            if action == SaleChange.CANCELLED:
+                yield [actions[action], changed_at, '', '', serial, '', '', '', '', '', '']
+            elif sale in sales:
+                yield [actions[action], changed_at] + sales[sale]
+        if len(chunk) < chunk_size:
+            break
+        last_id = chunk[-1][0]
+
+def csv_lines(rows, header=HEADER):
+    """
+    Yield ``header`` and then each of ``rows`` as a line of UTF-8
+    encoded CSV.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(header)
+    for row in rows:
+        writer.writerow([isinstance(v, unicode) and v.encode('utf-8') or v for v in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        #header only, there were no rows
+        yield buf.getvalue()
+
+def gzip_chunks(lines):
+    """
+    Gzip the strings yielded by ``lines`` as they are produced.
+    """
+    #a window size of 16 + MAX_WBITS makes zlib write a gzip wrapper
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for line in lines:
+        data = compressor.compress(line)
+        if data:
+            yield data
+    yield compressor.flush()
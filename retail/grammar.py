@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+The grammar of the SMS commands. A message is split into its keyword and
+arguments once, and the keyword looked up in COMMANDS, which gives the
+command and the fields its arguments are parsed into. Handlers then only
+compare the name of the command, instead of each trying its own keyword
+regex in turn, so overlapping keywords (s, st, c) can't be mistaken for
+one another.
+"""
+
+import re
+from decimal import Decimal, InvalidOperation
+from django.core.exceptions import ObjectDoesNotExist
+from rapidsms.contrib.handlers.handlers.base import BaseHandler
+
+#the keyword, then any arguments after a separator
+SPLIT = re.compile(r"^\s*([^\s,;:]+)(?:[\s,;:]+(.+?))?\s*$", re.DOTALL)
+
+#between the records of a batch command
+RECORDS = re.compile(r"\s*[;\n]\s*")
+
+
+class FieldError(Exception):
+    pass
+
+
+def serial(value):
+    from retail.models import Product
+    sn = value.upper()
+    if len(sn) < 7:
+        raise FieldError("SN %s too short" % sn)
+    if sn[0:2].isdigit():
+        raise FieldError("SN must start with a product code")
+    #product codes are the first two letters of the serial number
+    if Product.by_code(sn[0:2]) is None:
+        raise FieldError("product %s not found" % sn[0:2])
+    return sn
+
+def name(value):
+    if not value.isalpha():
+        raise FieldError("cust name %s not understood" % value)
+    if len(value) < 2:
+        raise FieldError("cust name %s too short" % value)
+    return value.capitalize()
+
+def phone(value):
+    if not value.isdigit():
+        raise FieldError("phone # can only be digits")
+    if len(value) < 10:
+        raise FieldError("phone # is mising digits")
+    return value
+
+def price(value):
+    try:
+        amount = Decimal(value)
+    except InvalidOperation:
+        raise FieldError("price %s is not a number" % value)
+    if amount > 50:
+        raise FieldError("price is too high")
+    if amount < 4:
+        raise FieldError("price is too low")
+    return amount
+
+def region(value):
+    from retail.models import Sale
+    code = value.upper()
+    if code not in dict(Sale.REGION_CHOICES):
+        raise FieldError("region %s not found" % code)
+    return code
+
+def words(values):
+    return ' '.join(v.capitalize() for v in values)
+
+
+#the fields of the sale command: the name each is returned as, the name
+#used in errors, and its parser. The words after the last are its rest
+SALE_FIELDS = (
+    ('serial', 'serial#', serial),
+    ('fname', 'firstname', name),
+    ('lname', 'lastname', name),
+    ('pri_phone', 'mobile#', phone),
+    ('purchase_price', 'price', price),
+    ('region', 'regioncode', region),
+    ('description', 'village', None),
+)
+
+#each command's name, keywords and fields. Commands with no fields are
+#handed their arguments as text, and those with fields of None take none.
+#A keyword may be shared by one command of each kind, as 'n' is: alone it
+#rejects a pending transfer, as it always has, and with arguments it adds
+#new product
+COMMANDS = (
+    ('sale',     ('sale', 's'),                           SALE_FIELDS),
+    ('sales',    ('sales', 'ss'),                         SALE_FIELDS),
+    ('cancel',   ('cancel',),                             ()),
+    ('check',    ('check', 'chk', 'ck', 'c'),             ()),
+    ('stock',    ('stock', 'stk', 'st'),                  ()),
+    ('manager',  ('manager', 'admin', 'm'),               ()),
+    ('new',      ('new', 'n', 'add'),                     ()),
+    ('register', ('register', 'reg', 'r', 'join'),        ()),
+    ('restock',  ('restock', 'rs'),                       ()),
+    ('language', ('language', 'lang'),                    ()),
+    ('yes',      ('yes', 'y'),                            None),
+    ('no',       ('no', 'n'),                             None),
+)
+
+#the commands of each keyword, by whether they take arguments
+KEYWORDS = {}
+for command, keywords, fields in COMMANDS:
+    for keyword in keywords:
+        KEYWORDS.setdefault(keyword, {})[fields is not None] = (command, fields)
+
+#commands taking several records, separated by RECORDS, of the fields of
+#another command
+BATCHES = {'sales': 'sale'}
+
+
+class Command(object):
+    """
+    A parsed message: the ``name`` of its command, the ``text`` of its
+    arguments, and for commands with fields, the value of each field
+    that could be parsed and an error for each that couldn't. A batch
+    command has a Command of the command it batches for each of its
+    ``records``.
+    """
+
+    def __init__(self, name, fields, text):
+        self.name = name
+        self.takes_args = fields is not None
+        self.text = text
+        self.fields = {}
+        self.errors = []
+        self.records = []
+        if fields and text:
+            if name in BATCHES:
+                self.records = [Command(BATCHES[name], fields, t) for t in RECORDS.split(text) if t]
+            else:
+                self.parse(fields, text.split())
+
+    def parse(self, fields, values):
+        if len(values) < len(fields):
+            missing = [label for name, label, parser in fields[len(values):]]
+            self.errors.append("missing %s" % ", ".join(missing))
+            return
+        for i, (name, label, parser) in enumerate(fields):
+            if parser is None:
+                self.fields[name] = words(values[i:])
+                continue
+            try:
+                self.fields[name] = parser(values[i])
+            except FieldError, err:
+                self.errors.append(unicode(err))
+
+
+def parse(text):
+    """
+    The Command ``text`` is, or None if it doesn't start with a keyword.
+    """
+    match = SPLIT.match(text)
+    if match is None:
+        return None
+    keyword, args = match.groups()
+    commands = KEYWORDS.get(keyword.lower())
+    if commands is None:
+        return None
+    found = commands.get(bool(args)) or commands.values()[0]
+    return Command(found[0], found[1], args)
+
+def command_of(msg):
+    """
+    The Command ``msg`` is, parsed only the first time it's asked for.
+    """
+    if not hasattr(msg, "command"):
+        msg.command = parse(msg.text)
+    return msg.command
+
+
+class CommandHandler(BaseHandler):
+    """
+    Handles the messages of one command of the grammar, named by
+    ``command``. ``handle`` is called with the text of the arguments, or
+    ``help`` if there are none. Commands that take no arguments call
+    ``handle`` with none.
+    """
+
+    command = None
+
+    @classmethod
+    def dispatch(cls, router, msg):
+        command = command_of(msg)
+        if command is None or command.name != cls.command:
+            return False
+
+        inst = cls(router, msg)
+        try:
+            if not command.takes_args:
+                inst.handle()
+            elif command.text:
+                inst.handle(command.text)
+            else:
+                inst.help()
+        #as for keyword handlers, an object that was expected but not
+        #found gets the "%s matching query does not exist." message
+        except ObjectDoesNotExist, err:
+            return inst.respond_error(unicode(err))
+        return True
@@ -1,19 +1,24 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
-from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
+from retail.grammar import CommandHandler
 from rapidsms.models import Contact
+from django.db import transaction
+from django.db.models import F
 from datetime import datetime
 from decimal import *
-from retail.models import Product, Stock, Sale
+from retail.models import Product, Stock, Sale, SaleChange
+from retail import caching
+from retail.timing import timed
 
-class CancelHandler(KeywordHandler):
+@timed
+class CancelHandler(CommandHandler):
     """
     Logic for cancelling a sale.
 
     """
 
-    keyword = "cancel"
+    command = "cancel"
 
     def help(self):
         self.respond("To cancel a sale use cancel serial#")
@@ -32,27 +37,24 @@ class CancelHandler(KeywordHandler):
         seller = to_cancel.seller
         owner_name = "%s %s" % (to_cancel.fname, to_cancel.lname)
         purchase_price = to_cancel.purchase_price
-        to_cancel.delete()
-        
-        #now increase the seller's stock by one to reflect the canceled sale
-        #this assumes the stock exists, and the seller only has one stock for a given product type
-        stk = Stock.objects.filter(seller=seller, product__code=serial[0:2])[0]
-        stk.stock_amount += 1
-        stk.save()
-        seller.cached_revenue -= (purchase_price * 1000)
-        seller.save()
+        with transaction.commit_on_success():
+            #return the stove to the seller's stock, which is unique per
+            #product, first: like a sale, a cancel then holds the stock
+            #until it commits, which rebuild_rollups relies on
+            returned = Stock.objects.filter(seller=seller.pk, product=to_cancel.product_id)\
+                .update(stock_amount=F('stock_amount') + 1)
+            if not returned:
+                Stock.objects.create(seller=seller, product_id=to_cancel.product_id, stock_amount=1)
+            revenue = int(purchase_price * 1000)
+            seller._meta.get_field('cached_revenue').model.objects.filter(pk=seller.pk)\
+                .update(cached_revenue=F('cached_revenue') - revenue)
+            seller.cached_revenue -= revenue
+
+            #deleting the sale takes it off the rollups
+            SaleChange.record(to_cancel, SaleChange.CANCELLED)
+            to_cancel.delete()
+        caching.bump(seller.organization_id)
 
         #confirm the cancellation
-        response = self.get_current_stock(seller)
+        response = Stock.summary(seller, self.msg)
         self.respond("Sale %s to %s canceled. Stock for %s: %s" % (serial, owner_name, seller.alias, response))
-
-    def get_current_stock(self, usr):
-        cur_stock = Stock.objects.filter(seller=usr)
-        response = ""
-        if cur_stock is not None:
-            for s in list(cur_stock):
-                response += "%s %s, " % (s.stock_amount, s.product.display_name)
-            return response.rstrip()[:-1]
-        else:
-            return "not found."
-                       
@@ -2,24 +2,73 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 import locale
-from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
+import re
+from retail.grammar import CommandHandler
 from retail.models import Sale
+from retail.timing import timed
 
-class StatusHandler(KeywordHandler):
+#characters in one SMS
+SEGMENT = 160
+
+@timed
+class StatusHandler(CommandHandler):
     """
-    Allow remote users to request information about a sale by SN.
+    Allow remote users to request information about a sale by SN, or
+    about several at once.
     """
 
-    keyword = "check|chk|ck|c"
+    command = "check"
 
     def help(self):
-        self.respond("Usage: c (serial number)\nExample: c EC12345")
+        self.respond("Usage: c (serial number)\nExample: c EC12345\nCheck several with: c EC12345 EC12346")
     
 
-    def handle(self, serial):
-        s = Sale.by_serial(serial)
-        if s:
-            locale.setlocale( locale.LC_ALL, '')
-            self.respond("%s: %s Tsh paid on %s. Owner: %s %s (%s) %s, %s" % (s.serial, locale.format('%d', s.purchase_price*1000, True), s.purchase_date.strftime("%d-%m-%y"), s.fname, s.lname, s.pri_phone, s.get_region_display(), s.description))
-        else:
-            self.respond("Serial number %s not recognized" % serial)
+    def handle(self, text):
+        serials = []
+        for serial in re.split(r"[\s,;]+", text.upper()):
+            if serial and serial not in serials:
+                serials.append(serial)
+        sales = Sale.by_serials(serials)
+        if len(serials) == 1:
+            serial = serials[0]
+            s = sales.get(serial)
+            if s:
+                locale.setlocale( locale.LC_ALL, '')
+                self.respond("%s: %s Tsh paid on %s. Owner: %s %s (%s) %s, %s" % (s.serial, locale.format('%d', s.purchase_price*1000, True), s.purchase_date.strftime("%d-%m-%y"), s.fname, s.lname, s.pri_phone, s.get_region_display(), s.description))
+            else:
+                self.respond("Serial number %s not recognized" % serial)
+            return
+
+        #group the serials by who sold them, so an audit of a delivery
+        #fits in a few messages
+        by_seller = {}
+        missing = []
+        for serial in serials:
+            if serial in sales:
+                by_seller.setdefault(sales[serial].seller.alias, []).append(serial)
+            else:
+                missing.append(serial)
+        parts = ["%s sold %s" % (alias, " ".join(found)) for alias, found in sorted(by_seller.items())]
+        if missing:
+            parts.append("not recognized %s" % " ".join(missing))
+        for message in self.pack(["%d of %d registered" % (len(serials) - len(missing), len(serials))] + parts):
+            self.respond(message)
+
+    def pack(self, parts):
+        """
+        Join ``parts`` into as few messages of SEGMENT characters as
+        possible, splitting a part between messages only at a space.
+        """
+        messages = [""]
+        for part in parts:
+            words = (part + ".").split(" ")
+            for i, word in enumerate(words):
+                sep = messages[-1] and " " or ""
+                if len(messages[-1]) + len(sep) + len(word) > SEGMENT:
+                    messages.append("")
+                    sep = ""
+                    if i > 0:
+                        #carry on with the part
+                        word = "... " + word
+                messages[-1] += sep + word
+        return messages
@@ -1,22 +1,24 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
-from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
+from retail.grammar import CommandHandler
 from rapidsms.models import Contact
 from retail.models import Stock
+from retail.timing import timed
 
-class CheckStockHandler(KeywordHandler):
+@timed
+class CheckStockHandler(CommandHandler):
     """
     Allow remote users to find out their, or another user's, current stock.
     """
 
-    keyword = "stock|stk|st|"
+    command = "stock"
 
     # Using the help function to return a users' own stock.
     # It's a hack, but it's a simple way to do it since no arguments are needed 	
     def help(self):
         user = self.msg.connection.contact
-        response = self.get_current_stock(user)
+        response = Stock.summary(user, self.msg)
         self.respond("Stock for %s: %s" % (user.alias, response))
 
     def handle(self, seller_alias):
@@ -25,15 +27,5 @@ class CheckStockHandler(KeywordHandler):
         except:
             self.respond("Sorry, user %s was not found. Please check your spelling and try again" % seller_alias)
         else:
-            response = self.get_current_stock(seller)
+            response = Stock.summary(seller, self.msg)
             self.respond("Stock for %s: %s" % (seller.alias, response))
-
-    def get_current_stock(self, usr):
-        cur_stock = Stock.objects.filter(seller=usr)
-        response = ""
-        if cur_stock is not None:
-            for s in list(cur_stock):
-                response += "%s %s, " % (s.stock_amount, s.product.display_name)
-            return response.rstrip()[:-1]
-        else:
-            return "not found."
@@ -1,16 +1,18 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
-from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
+from retail.grammar import CommandHandler
 from rapidsms.models import Contact
+from retail.timing import timed
 
-class GrantManagerHandler(KeywordHandler):
+@timed
+class GrantManagerHandler(CommandHandler):
     """
     Used by administrators to give manager permissions to another user (the target).
 
     """
 
-    keyword = "admin|manager|m"
+    command = "manager"
 
     def help(self):
         user = self.msg.connection.contact
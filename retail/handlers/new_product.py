@@ -1,17 +1,20 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
-from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
+from retail.grammar import CommandHandler
 from rapidsms.models import Contact
 from retail.models import Product, Stock
+from retail import caching
+from retail.timing import timed
 
-class NewProductHandler(KeywordHandler):
+@timed
+class NewProductHandler(CommandHandler):
     """
     Used by administrators to add newly recieved product into the system.
 
     """
 
-    keyword = "n|new|add"
+    command = "new"
 
     def help(self):
         user = self.msg.connection.contact
@@ -47,6 +50,7 @@ class NewProductHandler(KeywordHandler):
                     response += "%s %s, " % (amount, target_product.display_name)
         
         if response:
+            caching.bump(user.organization_id)
             response = response[:-2] + " added. "
        
         if errors:
@@ -54,7 +58,7 @@ class NewProductHandler(KeywordHandler):
                 response += "%s " % err
             response += "not recognized. "
         
-        self.respond("%sCurrent stock: %s" % (response, self.get_current_stock(user)))
+        self.respond("%sCurrent stock: %s" % (response, Stock.summary(user, self.msg)))
 
     def parse_restock_string(self, rstring):
         if rstring == '':
@@ -63,7 +67,7 @@ class NewProductHandler(KeywordHandler):
         restock_split = rstring.split(" ")
         for s in restock_split:
             code = (''.join([l for l in s if l.isalpha()])).upper()
-            exists = Product.objects.filter(code = code)
+            exists = Product.by_code(code)
             if exists:
                 amount_str = ''.join([d for d in s if d.isdigit()])
                 if amount_str.isdigit():
@@ -74,13 +78,3 @@ class NewProductHandler(KeywordHandler):
                 amount = 0 #code not found
             restock_list.append([code,amount])
         return restock_list
-
-    def get_current_stock(self, usr):
-        cur_stock = Stock.objects.filter(seller=usr)
-        response = ""
-        if cur_stock is not None:
-            for s in list(cur_stock):
-                response += "%s %s, " % (s.stock_amount, s.product.display_name)
-            return response.rstrip()[:-1]
-        else:
-            return "not found."
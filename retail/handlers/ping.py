@@ -3,8 +3,10 @@
 
 
 from rapidsms.contrib.handlers.handlers.base import BaseHandler
+from retail.timing import timed
 
 
+@timed
 class PingHandler(BaseHandler):
     """
     Handle the (precise) message ``ping``, by responding with ``pong``.
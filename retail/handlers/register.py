@@ -2,13 +2,16 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 
-from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
+from retail.grammar import CommandHandler
 from rapidsms.models import Contact
 from pikwa.retail.models import Organization 
+from pikwa.retail import caching
 from django.db import IntegrityError
+from retail.timing import timed
 
 
-class RegisterHandler(KeywordHandler):
+@timed
+class RegisterHandler(CommandHandler):
     """
     Allow remote users to register themselves, by creating a Contact
     object and associating it with their Connection and an existing organization. For example:
@@ -20,7 +23,7 @@ class RegisterHandler(KeywordHandler):
         [<Contact: Adam Mckaig>]
     """
 
-    keyword = "register|reg|r|join"
+    command = "register"
 
     def help(self):
         self.respond("To register, send reg <NAME> <ALIAS> <ORGANIZATION>")
@@ -53,6 +56,7 @@ class RegisterHandler(KeywordHandler):
             new_contact = Contact.objects.create(name = name, alias = alias, organization = org, role = role)
             self.msg.connection.contact = new_contact
             self.msg.connection.save()
+            caching.bump(org.id)
             self.respond(
             "Thank you for registering, %(name)s! Your username is %(alias)s and your organization is %(org)s.",
             name=new_contact.name, alias=new_contact.alias, org=new_contact.organization)
@@ -2,12 +2,13 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 
-from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
+from retail.grammar import CommandHandler
 from rapidsms.models import Contact
 from retail.models import Product, Stock, StockTransaction
-from datetime import datetime
+from retail.timing import timed
 
-class RestockHandler(KeywordHandler):
+@timed
+class RestockHandler(CommandHandler):
     """
     Allow remote users to transfer stock to another user.
     Transfers are from one user (the 'stocker') to another (the 'target').
@@ -15,7 +16,7 @@ class RestockHandler(KeywordHandler):
 
     """
 
-    keyword = "restock|rs"
+    command = "restock"
 
     def help(self):
         self.respond("Usage: restock (recipient) (code)(amount)\nExample: restock dnombo 5ew")
@@ -41,47 +42,37 @@ class RestockHandler(KeywordHandler):
             return True
 
         errors = []
-        stockouts = []
-        pending = []
+        codes, amounts = [], {}
         response = ""
         notification = ""
-        #admin must create this user, for holding pending stock transactions
-        nobody = Contact.by_alias("nobody")
 
         for code, amount in restock_list:
-            if amount == 0:
-                errors.append(code)
             if amount == -1 or code == '':
                 self.respond("Missing product code or amount. Restock messages cannot contain spaces.\nExample: restock dnombo 5ew")
                 return True
+            elif amount == 0:
+                errors.append(code)
+            elif code in amounts:
+                #a product given twice is sent, or left out, as one line
+                amounts[code] += amount
             else:
-                current_stock = Stock.get_existing(stocker.alias, code)
-                #make sure the initiator of the transaction has enough stock
-                if current_stock is None or current_stock.stock_amount < amount:
-                    stockouts.append(code)
-                else:
-                    target_product = Product.by_code(code)
-                    s = Stock(seller = nobody, product=target_product, stock_amount=amount)
-                    s.save()
-                    pending.append(s)
-                    current_stock.stock_amount -= amount
-                    current_stock.save()
-
-        if pending:
-            #create the transaction object and add stock to be moved
-            trans = StockTransaction(initiator = stocker, recipient = target, status = 2, date_initiated = datetime.now())
-            trans.save() #need to generate a primary key before adding products
-            for p in pending:
-                trans.to_transfer.add(p)
-                response += "%s %s " % (p.stock_amount, p.product.display_name)
-                notification += "%s %s " % (p.stock_amount, p.product.display_name)
-
-            trans.save()
+                amounts[code] = amount
+                codes.append(code)
+        items = [(Product.by_code(code), amounts[code]) for code in codes]
+
+        #the stock is taken from the stocker now, and held on the
+        #transaction until the target accepts or rejects it
+        trans, stockouts = StockTransaction.start(stocker, target, items)
+        if trans is not None:
+            for product, amount in items:
+                if product not in stockouts:
+                    response += "%s %s " % (amount, product.display_name)
+                    notification += "%s %s " % (amount, product.display_name)
             response += "sent to %s. " % target.alias
 
         if stockouts:
             for out in stockouts:
-                response += "%s " % out
+                response += "%s " % out.code
             response += "out of stock. "
 
         if errors:
@@ -102,7 +93,7 @@ class RestockHandler(KeywordHandler):
         restock_split = rstring.split(" ")
         for s in restock_split:
             code = (''.join([l for l in s if l.isalpha()])).upper()
-            exists = Product.objects.filter(code = code)
+            exists = Product.by_code(code)
             if exists:
                 amount_str = ''.join([d for d in s if d.isdigit()])
                 if amount_str.isdigit():
@@ -118,35 +109,9 @@ class RestockHandler(KeywordHandler):
        This exists so that if stocker starts a restock, and the target never accepts or
        rejects the transfer, they can get their stock back.'''  
     def cancel_restocks(self, stocker):
-        pending_restocks = StockTransaction.objects.filter(initiator = stocker, status = 2)
-        if not pending_restocks:
-            self.respond("No transactions were pending. current stock %s." % (self.get_current_stock(stocker)))
+        canceled = StockTransaction.settle(StockTransaction.objects.filter(initiator=stocker.pk), StockTransaction.CANCELLED)
+        if not canceled:
+            self.respond("No transactions were pending. current stock %s." % (Stock.summary(stocker, self.msg)))
             return True
-        for p in pending_restocks:
-            stk_list = p.to_transfer.all()
-            for stk in stk_list:
-                existing = Stock.get_existing(stocker.alias, stk.product.code)
-                if existing:
-                    existing.stock_amount += stk.stock_amount
-                    existing.save()
-                    stk.delete()
-                else:
-                    stk.seller = stocker
-                    stk.save()
-            p.status = 3
-            p.date_resolved = datetime.now()
-            p.save()
-        self.respond("All pending transfers canceled, current stock %s." % (self.get_current_stock(stocker)))
+        self.respond("All pending transfers canceled, current stock %s." % (Stock.summary(stocker, self.msg)))
         return True
-
-    def get_current_stock(self, usr):
-        cur_stock = Stock.objects.filter(seller=usr)
-        response = ""
-        if cur_stock is not None:
-            for s in list(cur_stock):
-                response += "%s %s, " % (s.stock_amount, s.product.display_name)
-            return response.rstrip()[:-1]
-        else:
-            return "not found."
-            
-        
@@ -1,135 +1,44 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
-from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
-from rapidsms.models import Contact
+from retail.grammar import CommandHandler
 from datetime import datetime
-from decimal import *
-from retail.models import Product, Stock, Sale
+from django.db import IntegrityError
+from retail.models import Product, Sale, OutOfStock
+from retail.timing import timed
 
-class SaleHandler(KeywordHandler):
+@timed
+class SaleHandler(CommandHandler):
     """
     Logic for recording a sale.
 
     """
 
-    keyword = "sale|s"
+    command = "sale"
 
     def help(self):
         self.respond("Sale format: sale serial# firstname lastname mobile# price regioncode village")
 
     def handle(self, sale_string):
-        seller = self.msg.connection.contact
-        sale_result = self.verify_sale(sale_string, seller)
-        if sale_result[0] == 0: #sale failed
-            self.respond("ERROR: " + ', '.join(sale_result[1]) + ". Sale format: sale serial# firstname lastname mobile# price regioncode description" )
-        else:
-            sale_data = sale_result[1]
-            product_code = sale_result[2]
-        
-        #verify that seller has the item to be sold in stock
-        current_stock = Stock.get_existing(sale_data['seller'].alias, product_code)
-        if current_stock is None or current_stock.stock_amount <= 0:
+        command = self.msg.command
+        if command.errors:
+            self.respond("ERROR: " + ', '.join(command.errors) + ". Sale format: sale serial# firstname lastname mobile# price regioncode description" )
+            return True
+        sale_data = command.fields
+        product_code = sale_data['serial'][0:2]
+
+        #saving the sale takes it out of the retailer's stock, and fails
+        #if there's none left or the serial # is a duplicate
+        s = Sale(seller=self.msg.connection.contact, product=Product.by_code(product_code),
+                 purchase_date=datetime.now(), **sale_data)
+        try:
+            s.save()
+        except OutOfStock:
             self.respond("ERROR: No %s in stock." % product_code)
             return True
-        
-        #verify that the serial # is not a duplicate
-        exists = Sale.by_serial(sale_data['serial'])
-        if exists:
+        except IntegrityError:
             self.respond("ERROR: %s is already registered." % sale_data['serial'])
             return True
-          
-        #now create and save the new sale record
-        s = Sale(**sale_data)
-        s.save()
-        
-        #subtract the sale from the retailer's stock
-        current_stock.stock_amount -= 1
-        current_stock.save()
         
         payment_response = "Cash sale."
         self.respond("%s registered to %s %s by %s." % (s.serial, s.fname, s.lname, s.seller.alias, ) + " " + payment_response)        
-
-
-    def verify_sale(self, input, rep):
-        """
-        parsing and error checking for sales
-        """
-
-        #assume a valid sale, change status to 0 if we encounter an error
-        status = 1
-        errors = []
-        
-        data_list = input.split()
-        if len(data_list) < 7:
-            status = 0
-            errors.append("Sale missing information. Please check the format and try again")
-            return ([status, errors])            
-        
-        #check serial number
-        sn = data_list[0].upper()
-        #FIXME Loosening the length check temporarily to accomodate new
-        #Envirofit SN format
-        ##############################################################
-        if len(sn) < 7:
-            errors.append("SN too short")
-        if sn[0:2].isdigit():
-            errors.append("SN must start with a product code")
-        
-        #get product code
-        #this assumes product codes are all letters, and they're the only letters in a serial number
-        #FIXME (?) Chaning this to accomodate Envirofit, but maybe it's 
-        #better anyway?
-        ##############################################################
-        #product_code = (''.join([l for l in sn if l.isalpha()])).upper()
-        product_code = sn[0:2]
-        prod = Product.by_code(product_code)
-        if not prod:
-            errors.append("product %s not found" % product_code)
-            
-        #check product owner's name
-        if not ((data_list[1] + data_list[2]).isalpha()):
-            errors.append("cust name not understood")
-        if (len(data_list[1]) < 2 or len(data_list[2]) < 2):
-            errors.append("cust name too short")
-        else:
-            first = data_list[1].title()
-            last = data_list[2].title()
-        
-        #check phone
-        if not (data_list[3].isdigit()):
-            errors.append("phone # can only be digits")
-        if len(data_list[3]) < 10:
-            errors.append("phone # is mising digits")
-        
-        #check price
-        price = Decimal(data_list[4])
-        if price > 50:
-            errors.append("price is too high")
-        if price < 4:
-            errors.append("price is too low")        
-        
-        #check region
-        #this is a placeholder for now
-        region =  data_list[5].upper()
-                
-        #take anything left as free text description
-        des = ' '.join(d.capitalize() for d in data_list[6:])   
-        
-        if errors:
-            #something went wrong, return error messages
-            status = 0
-            return ([status, errors])
-        else: 
-            #nothing went wrong, return sale data
-            sale_dict = dict ({'seller': rep,
-                               'serial': sn,
-                               'product': prod,
-                               'fname': data_list[1].capitalize(),
-                               'lname': data_list[2].capitalize(),
-                               'pri_phone': data_list[3],
-                               'purchase_price': price,
-                               'purchase_date': datetime.now(),
-                               'region': region,
-                               'description': des})
-            return ([status, sale_dict, product_code])            
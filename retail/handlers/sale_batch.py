@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+from retail.grammar import CommandHandler
+from datetime import datetime
+from retail.models import Product, Sale
+from retail.timing import timed
+
+@timed
+class SaleBatchHandler(CommandHandler):
+    """
+    Records several sales sent in one message, separated by ; or new
+    lines, and confirms them all in one reply.
+    """
+
+    command = "sales"
+
+    def help(self):
+        self.respond("Sales format: sales serial# firstname lastname mobile# price regioncode village; serial# ...")
+
+    def handle(self, text):
+        seller = self.msg.connection.contact
+        now = datetime.now()
+        sales, rejected = [], []
+        for record in self.msg.command.records:
+            if record.errors:
+                rejected.append((record.text.split()[0].upper(), ', '.join(record.errors)))
+                continue
+            product = Product.by_code(record.fields['serial'][0:2])
+            sales.append(Sale(seller=seller, product=product, purchase_date=now, **record.fields))
+
+        saved, refused = Sale.save_many(sales)
+        rejected.extend((sale.serial, reason) for sale, reason in refused)
+
+        response = "%d sales registered by %s" % (len(saved), seller.alias)
+        if saved:
+            response += ": " + ", ".join(s.serial for s in saved)
+        response += "."
+        if rejected:
+            response += " ERROR: " + "; ".join("%s %s" % r for r in rejected) + "."
+        self.respond(response)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""
+Sales import from CSV. The file is read a chunk of rows at a time, each
+row checked with the same rules as a sale sent by SMS (see grammar), and
+each chunk saved with Sale.save_many, so memory use doesn't grow with the
+size of the file. Rows that can't be imported are written to a second
+CSV file, with the reason for each.
+"""
+
+import csv
+from datetime import datetime
+
+from rapidsms.models import Contact
+from retail import grammar
+from retail.models import Product, Sale
+
+CHUNK_SIZE = 1000
+
+#column names, in the order of the template file
+HEADER = ['Sale date', 'Retailer alias', 'Serial #', 'First name', 'Last name', 'Primary phone',
+          'Price', 'Region', 'Location notes']
+
+#the column, field and parser of the fields parsed as the sale command's
+FIELDS = (
+    ('Serial #', 'serial', grammar.serial),
+    ('First name', 'fname', grammar.name),
+    ('Last name', 'lname', grammar.name),
+    ('Primary phone', 'pri_phone', grammar.phone),
+    ('Price', 'purchase_price', grammar.price),
+)
+
+DATE_FORMATS = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y")
+
+def decode(value):
+    """
+    A cell of a CSV file as unicode, without surrounding spaces.
+    """
+    try:
+        return value.decode("utf-8").strip()
+    except UnicodeDecodeError:
+        #spreadsheets saved on windows
+        return value.decode("cp1252").strip()
+
+def _date(value):
+    for format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise grammar.FieldError("date %s not understood" % value)
+
+def parse_row(values, regions):
+    """
+    The fields of the sale in the row ``values``, by column name, and an
+    error for each that couldn't be parsed.
+    """
+    fields, errors = {}, []
+    for column, name, parser in FIELDS:
+        try:
+            fields[name] = parser(values.get(column, ""))
+        except grammar.FieldError, err:
+            errors.append(unicode(err))
+    #regions may be given by name, as in exports, or by code
+    region = values.get('Region', "")
+    try:
+        fields['region'] = grammar.region(regions.get(region.lower(), region))
+    except grammar.FieldError, err:
+        errors.append(unicode(err))
+    try:
+        fields['purchase_date'] = _date(values.get('Sale date', ""))
+    except grammar.FieldError, err:
+        errors.append(unicode(err))
+    description = values.get('Location notes', "")
+    if not description or len(description) > Sale._meta.get_field('description').max_length:
+        errors.append("location notes missing or too long")
+    fields['description'] = description
+    return fields, errors
+
+def import_sales(lines, rejected, organization_id=None, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Import the sales in the CSV ``lines``, writing the rows that can't be
+    to the file ``rejected``. Only the sellers of ``organization_id`` are
+    recognized, unless it's None. ``progress`` is called with the counts
+    of rows read, imported and rejected after each chunk.
+    """
+    reader = csv.reader(lines)
+    writer = csv.writer(rejected)
+    try:
+        header = [decode(h) for h in reader.next()]
+    except StopIteration:
+        raise ValueError("The file is empty")
+    missing = [h for h in HEADER if h not in header]
+    if missing:
+        raise ValueError("The file has no %s column" % ", ".join(missing))
+    writer.writerow([h.encode("utf-8") for h in header] + ["Error"])
+
+    regions = dict((name.lower(), code) for code, name in Sale.REGION_CHOICES)
+    #sellers seen in earlier chunks, by alias
+    sellers = {}
+    counts = {"read": 0, "imported": 0, "rejected": 0}
+
+    def reject(row, reason):
+        writer.writerow(row + [reason.encode("utf-8")])
+        counts["rejected"] += 1
+
+    def import_chunk(rows):
+        aliases = set(decode(row[header.index('Retailer alias')]).lower()
+                      for row in rows if len(row) == len(header)) - set(sellers)
+        if aliases:
+            found = Contact.objects.filter(alias__in=aliases)
+            if organization_id is not None:
+                found = found.filter(organization=organization_id)
+            for contact in found:
+                sellers[contact.alias.lower()] = contact
+            for alias in aliases:
+                sellers.setdefault(alias, None)
+
+        sales, sale_rows = [], {}
+        for row in rows:
+            if len(row) != len(header):
+                reject(row, "has %d columns, not %d" % (len(row), len(header)))
+                continue
+            values = dict(zip(header, [decode(v) for v in row]))
+            fields, errors = parse_row(values, regions)
+            seller = sellers.get(values['Retailer alias'].lower())
+            if seller is None:
+                errors.append("retailer %s not found" % values['Retailer alias'])
+            if errors:
+                reject(row, ", ".join(errors))
+                continue
+            sale = Sale(seller=seller, product=Product.by_code(fields['serial'][0:2]), **fields)
+            sales.append(sale)
+            sale_rows[id(sale)] = row
+
+        saved, refused = Sale.save_many(sales)
+        for sale, reason in refused:
+            reject(sale_rows[id(sale)], reason)
+        counts["imported"] += len(saved)
+
+    chunk = []
+    for row in reader:
+        if not row:
+            continue
+        chunk.append(row)
+        counts["read"] += 1
+        if len(chunk) == chunk_size:
+            import_chunk(chunk)
+            chunk = []
+            if progress:
+                progress(counts["read"], counts["imported"], counts["rejected"])
+    if chunk:
+        import_chunk(chunk)
+    if progress:
+        progress(counts["read"], counts["imported"], counts["rejected"])
+    return counts
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import os
+import re
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction, DatabaseError
+from django.db.models import Sum, Min, Count
+from retail.models import Stock
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "sql")
+
+
+def index_statements():
+    """
+    The CREATE INDEX statements in retail/sql, which syncdb runs for new
+    tables.
+    """
+    statements = []
+    for name in sorted(os.listdir(SQL_DIR)):
+        if not name.endswith(".sql"):
+            continue
+        sql = open(os.path.join(SQL_DIR, name)).read()
+        sql = "\n".join(l for l in sql.splitlines() if not l.strip().startswith("--"))
+        statements.extend(s.strip() for s in sql.split(";") if s.strip())
+    return statements
+
+
+class Command(NoArgsCommand):
+    help = ("Adds the retail indexes, and the unique (seller, product) constraint on stock, "
+            "to a database created before they were. Duplicate stock rows are merged first.")
+
+    @transaction.commit_manually
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        qn = connection.ops.quote_name
+        try:
+            #a seller's duplicate rows for a product are added into the first
+            merged = 0
+            duplicates = Stock.objects.values("seller", "product").order_by()\
+                .annotate(rows=Count("id"), first=Min("id"), total=Sum("stock_amount")).filter(rows__gt=1)
+            for d in duplicates:
+                Stock.objects.filter(pk=d["first"]).update(stock_amount=d["total"])
+                Stock.objects.filter(seller=d["seller"], product=d["product"]).exclude(pk=d["first"]).delete()
+                merged += d["rows"] - 1
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        if verbosity > 0:
+            self.stdout.write("Merged %d duplicate stock rows\n" % merged)
+
+        statements = ["CREATE UNIQUE INDEX %s ON %s (%s, %s)" % (
+            qn("retail_stock_seller_product"), qn(Stock._meta.db_table), qn("seller_id"), qn("product_id"))]
+        statements.extend(index_statements())
+        for sql in statements:
+            name = re.search(r"INDEX\s+(\S+)", sql).group(1)
+            try:
+                connection.cursor().execute(sql)
+                transaction.commit()
+            except DatabaseError, err:
+                #most likely created by syncdb or an earlier run
+                transaction.rollback()
+                if verbosity > 0:
+                    self.stdout.write("Skipped %s: %s\n" % (name, err))
+            else:
+                if verbosity > 0:
+                    self.stdout.write("Created %s\n" % name)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import random
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import simplejson
+
+import rapidsms.router
+from rapidsms.router import Router
+from rapidsms.models import Backend, Connection, Contact
+
+from retail.models import Organization, Product, Stock, Sale, StockTransaction, insert_many
+
+BACKEND = "message_tester"
+
+#synthetic contacts and organizations are recognised by these prefixes
+ALIAS = "lt"
+ORG_CODE = "L"
+
+THREADED_APPS = ("rapidsms.contrib.ajax", "rapidsms.contrib.scheduler")
+
+#the serials of sales sent during a replay follow the product code with
+#this digit, which those of the dataset's sales don't
+REPLAY_SERIAL = "9"
+
+DEFAULT_MIX = "sale=40,stock=20,check=20,restock=8,yes=4,no=3,cancel=3,new=2"
+
+
+def product_code(i):
+    #serials start with the two letter product code
+    return chr(65 + i / 26 % 26) + chr(65 + i % 26)
+
+
+def percentile(values, q):
+    return values[int(round(q * (len(values) - 1)))]
+
+
+class Command(NoArgsCommand):
+    help = ("Builds a synthetic dataset, and replays a mix of SMS commands through the router "
+            "and the %s bucket backend, reporting the throughput, latency and queries per "
+            "message of each command as JSON. Only run it against a scratch database." % BACKEND)
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--populate", action="store_true", dest="populate", default=False,
+            help="Create the dataset first. Without this, the dataset from an earlier run is used."),
+        make_option("--orgs", dest="orgs", type="int", default=5,
+            help="Number of organizations (default 5)."),
+        make_option("--sellers", dest="sellers", type="int", default=200,
+            help="Number of sellers, spread over the organizations (default 200)."),
+        make_option("--products", dest="products", type="int", default=5,
+            help="Number of products (default 5)."),
+        make_option("--sales", dest="sales", type="int", default=100000,
+            help="Number of sales over the past year (default 100000)."),
+        make_option("--transfers", dest="transfers", type="int", default=50,
+            help="Number of pending transfers (default 50)."),
+        make_option("--messages", dest="messages", type="int", default=1000,
+            help="Number of messages to replay (default 1000)."),
+        make_option("--mix", dest="mix", default=DEFAULT_MIX,
+            help="Weight of each command in the replay (default %s)." % DEFAULT_MIX),
+        make_option("--seed", dest="seed", type="int", default=0,
+            help="Random seed, so runs can be compared (default 0)."),
+        make_option("--output", dest="output", default=None,
+            help="Write the JSON report to this file instead of stdout."),
+    )
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get("verbosity", 1))
+        self.random = random.Random(options["seed"])
+        if options["populate"]:
+            if Organization.objects.filter(code__startswith=ORG_CODE).exists():
+                raise CommandError("A synthetic dataset already exists in this database.")
+            self.populate(options["orgs"], options["sellers"], options["products"],
+                          options["sales"], options["transfers"])
+
+        sellers = list(Contact.objects.filter(alias__startswith=ALIAS).order_by("alias"))
+        if not sellers:
+            raise CommandError("No synthetic dataset found, run with --populate first.")
+        mix = []
+        for item in options["mix"].split(","):
+            command, weight = item.split("=")
+            if not hasattr(self, "message_%s" % command):
+                raise CommandError("Unknown command in the mix: %s" % command)
+            mix.extend([command] * int(weight))
+
+        report = self.replay(sellers, mix, options["messages"])
+        report["dataset"] = {
+            "organizations": Organization.objects.filter(code__startswith=ORG_CODE).count(),
+            "sellers": len(sellers),
+            "products": Product.objects.count(),
+            "sales": Sale.objects.count(),
+            "pending_transfers": StockTransaction.objects.filter(status=StockTransaction.PENDING).count(),
+        }
+        report["options"] = dict((k, options[k]) for k in ("messages", "mix", "seed"))
+        output = simplejson.dumps(report, indent=2, sort_keys=True)
+        if options["output"]:
+            f = open(options["output"], "w")
+            f.write(output)
+            f.close()
+        else:
+            self.stdout.write(output + "\n")
+
+    def log(self, text):
+        if self.verbosity > 1:
+            self.stderr.write(text + "\n")
+
+    @transaction.commit_on_success
+    def populate(self, n_orgs, n_sellers, n_products, n_sales, n_transfers):
+        backend, created = Backend.objects.get_or_create(name=BACKEND)
+        orgs = [Organization.objects.create(code="%s%03d" % (ORG_CODE, i), display_name="Load %d" % i,
+                                            full_name="Load test %d" % i) for i in range(n_orgs)]
+        products = []
+        for i in range(n_products):
+            code = product_code(i)
+            product = Product.by_code(code)
+            if product is None:
+                product = Product.objects.create(code=code, display_name="Stove %s" % code,
+                                                 full_name="Load test stove %s" % code)
+            products.append(product)
+
+        sellers = []
+        for i in range(n_sellers):
+            #the first seller of each organization is its manager
+            seller = Contact.objects.create(name="Load Seller %d" % i, alias="%s%d" % (ALIAS, i),
+                                            organization=orgs[i % n_orgs], role=(i < n_orgs) and 1 or 0)
+            Connection.objects.create(backend=backend, identity="0799%07d" % i, contact=seller)
+            for product in products:
+                Stock.objects.create(seller=seller, product=product, stock_amount=1000000)
+            sellers.append(seller)
+        self.log("Created %d organizations, %d products and %d sellers" % (n_orgs, n_products, n_sellers))
+
+        #sales are inserted many rows per statement, and the totals they'd
+        #have updated are filled in afterwards
+        regions = [code for code, name in Sale.REGION_CHOICES]
+        revenue = {}
+        now = datetime.now()
+        sales = []
+        for i in range(n_sales):
+            seller = sellers[self.random.randrange(n_sellers)]
+            product = products[self.random.randrange(n_products)]
+            price = Decimal(self.random.randrange(8, 40))
+            sale = Sale(serial="%s%08d" % (product.code, i), product=product, seller=seller,
+                        purchase_date=now - timedelta(seconds=self.random.randrange(365 * 86400)),
+                        fname="Load", lname="Customer", pri_phone="0712345678", purchase_price=price,
+                        #each seller works in one region, as they do in practice
+                        region=regions[seller.pk % len(regions)], description="Village")
+            sales.append(sale)
+            revenue[seller.pk] = revenue.get(seller.pk, 0) + int(price * 1000)
+            if len(sales) == 5000 or i == n_sales - 1:
+                insert_many(Sale, sales)
+                sales = []
+                self.log("Inserted %d sales" % (i + 1))
+        seller_table = Contact._meta.get_field("cached_revenue").model
+        for seller_pk, total in revenue.items():
+            seller_table.objects.filter(pk=seller_pk).update(cached_revenue=total)
+        call_command("rebuild_rollups", verbosity=self.verbosity - 1)
+
+        for i in range(n_transfers):
+            initiator = sellers[self.random.randrange(n_sellers)]
+            recipient = sellers[self.random.randrange(n_sellers)]
+            StockTransaction.start(initiator, recipient, [(products[self.random.randrange(n_products)], 5)])
+        self.log("Created %d pending transfers" % n_transfers)
+
+    def replay(self, sellers, mix, n_messages):
+        self.sellers = sellers
+        self.identities = dict(Connection.objects.filter(contact__in=[s.pk for s in sellers])
+                                                 .values_list("contact", "identity"))
+        self.products = Product.catalog().values()
+        self.serials = list(Sale.objects.order_by("?").values_list("serial", flat=True)[:1000])
+        self.recipients = list(StockTransaction.objects.filter(status=StockTransaction.PENDING)
+                                                       .values_list("recipient", flat=True))
+        self.sold = []
+        self.next_serial = self.first_serial()
+
+        #the same apps as the router process, handling each message as
+        #soon as it's received. The apps that only run threads of their
+        #own are left out, as they'd fight a running router for its port
+        real_router = rapidsms.router.router
+        router = rapidsms.router.router = Router()
+        for name in settings.INSTALLED_APPS:
+            if name not in THREADED_APPS:
+                router.add_app(name)
+        backend = router.add_backend(BACKEND, "rapidsms.backends.bucket")
+        backend.bucket = []
+        for app in router.apps:
+            app.start()
+        router.running = True
+
+        timings = {}
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        started = time.time()
+        try:
+            for i in range(n_messages):
+                command = mix[self.random.randrange(len(mix))]
+                sender, text = getattr(self, "message_%s" % command)()
+                connection.queries = []
+                before = time.time()
+                router.incoming(backend.message(self.identities[sender.pk], text))
+                elapsed = time.time() - before
+                #replies can't grow without bound over a long run
+                backend.bucket = []
+                keyword = text.split(" ")[0]
+                timings.setdefault(keyword, []).append((elapsed, len(connection.queries)))
+        finally:
+            elapsed = time.time() - started
+            connection.use_debug_cursor = use_debug_cursor
+            router.running = False
+            rapidsms.router.router = real_router
+
+        report = {
+            "messages": n_messages,
+            "seconds": round(elapsed, 3),
+            "messages_per_second": round(n_messages / elapsed, 1),
+            "queries_per_message": round(sum(q for t in timings.values() for e, q in t) / float(n_messages), 2),
+            "commands": {},
+        }
+        for keyword, samples in timings.items():
+            latencies = sorted(e * 1000 for e, q in samples)
+            report["commands"][keyword] = {
+                "messages": len(samples),
+                "p50_ms": round(percentile(latencies, 0.50), 2),
+                "p95_ms": round(percentile(latencies, 0.95), 2),
+                "p99_ms": round(percentile(latencies, 0.99), 2),
+                "queries_per_message": round(sum(q for e, q in samples) / float(len(samples)), 2),
+            }
+        return report
+
+    def first_serial(self):
+        """
+        The number after the highest of the serials sold by earlier runs,
+        so each run registers new sales, and cancels only its own.
+        """
+        last = 0
+        for product in self.products:
+            serial = Sale.objects.filter(serial__startswith="%s%s" % (product.code, REPLAY_SERIAL))\
+                .aggregate(Max("serial"))["serial__max"]
+            if serial:
+                last = max(last, int(serial[len(product.code) + 1:]))
+        return last + 1
+
+    #each of these returns the sender and text of one message of the mix
+
+    def seller(self):
+        return self.sellers[self.random.randrange(len(self.sellers))]
+
+    def product(self):
+        return self.products[self.random.randrange(len(self.products))]
+
+    def message_sale(self):
+        seller = self.seller()
+        serial = "%s%s%07d" % (self.product().code, REPLAY_SERIAL, self.next_serial)
+        self.next_serial += 1
+        self.sold.append((seller, serial))
+        return seller, "sale %s load customer 0712345678 25 A village" % serial
+
+    def message_cancel(self):
+        if not self.sold:
+            return self.message_sale()
+        seller, serial = self.sold.pop(self.random.randrange(len(self.sold)))
+        return seller, "cancel %s" % serial
+
+    def message_stock(self):
+        return self.seller(), "stock"
+
+    def message_check(self):
+        return self.seller(), "check %s" % self.serials[self.random.randrange(len(self.serials))]
+
+    def message_restock(self):
+        seller, recipient = self.seller(), self.seller()
+        self.recipients.append(recipient.pk)
+        return seller, "restock %s 2%s" % (recipient.alias, self.product().code.lower())
+
+    def message_yes(self):
+        if not self.recipients:
+            return self.message_restock()
+        pk = self.recipients.pop(self.random.randrange(len(self.recipients)))
+        return [s for s in self.sellers if s.pk == pk][0], "yes"
+
+    def message_no(self):
+        if not self.recipients:
+            return self.message_restock()
+        pk = self.recipients.pop(self.random.randrange(len(self.recipients)))
+        return [s for s in self.sellers if s.pk == pk][0], "no"
+
+    def message_new(self):
+        managers = [s for s in self.sellers if s.role]
+        return managers[self.random.randrange(len(managers))], "new 10%s" % self.product().code.lower()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+from datetime import date, datetime
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from retail.models import Stock, StockTransaction, Sale, SaleRollup
+
+
+def hot_queries():
+    """
+    (name, queryset) pairs for the lookups made for every message or
+    page view. The values filtered on don't matter to the plan.
+    """
+    return [
+        ("Stock.get_existing", Stock.objects.filter(seller__alias="x", product__code="x")),
+        ("stock of seller and product", Stock.objects.filter(seller=1, product=1)),
+        ("pending transfers to recipient", StockTransaction.objects.filter(recipient=1, status=StockTransaction.PENDING)),
+        ("pending transfers from initiator", StockTransaction.objects.filter(initiator=1, status=StockTransaction.PENDING)),
+        ("seller's last sale", Sale.objects.filter(seller=1).order_by("-purchase_date")[:1]),
+        ("sales page after a cursor", Sale.objects.filter(purchase_date__lte=datetime.now())
+            .filter(Q(purchase_date__lt=datetime.now()) | Q(serial__lt="x"))
+            .order_by("-purchase_date", "-serial")[:21]),
+        ("organization's rollups by day", SaleRollup.objects.filter(organization=1, day__gte=date.today())),
+        ("seller's rollups", SaleRollup.objects.filter(seller=1)),
+    ]
+
+
+def explain(queryset):
+    """
+    The query plan of ``queryset`` as a list of lines.
+    """
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    vendor = connection.settings_dict["ENGINE"].split(".")[-1]
+    cursor = connection.cursor()
+    if vendor == "sqlite3":
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [" ".join(unicode(c) for c in row[3:]) for row in cursor.fetchall()]
+    if vendor.startswith("postgresql"):
+        #the check tables are usually small enough for a sequential scan
+        #to win, so ask what would be used if it didn't
+        cursor.execute("SET enable_seqscan = off")
+    cursor.execute("EXPLAIN " + sql, params)
+    return [" ".join(unicode(c) for c in row) for row in cursor.fetchall()]
+
+
+def uses_index(plan):
+    """
+    Whether each table in ``plan`` is read through an index. Understands
+    sqlite and postgresql plans.
+    """
+    for line in plan:
+        if line.startswith("SCAN") and "INDEX" not in line:
+            return False
+        if "Seq Scan" in line:
+            return False
+    return True
+
+
+class Command(NoArgsCommand):
+    help = "Prints the query plan of each hot lookup, and fails if any of them scans a whole table."
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        scans = []
+        for name, queryset in hot_queries():
+            plan = explain(queryset)
+            ok = uses_index(plan)
+            if not ok:
+                scans.append(name)
+            if verbosity > 0:
+                self.stdout.write("%s %s\n" % (ok and "ok  " or "SCAN", name))
+            if verbosity > 1 or (verbosity > 0 and not ok):
+                for line in plan:
+                    self.stdout.write("        %s\n" % line)
+        if scans:
+            raise CommandError("%d hot queries scan a whole table: %s" % (len(scans), ", ".join(scans)))
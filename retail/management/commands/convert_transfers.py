@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from rapidsms.models import Contact
+from retail.models import Stock, StockTransaction, TransferLine
+
+OLD_TABLE = "retail_stocktransaction_to_transfer"
+
+
+class Command(NoArgsCommand):
+    help = ("Converts the stock held by 'nobody' for pending transfers into transfer "
+            "lines, and drops the old transfer to stock table. Run syncdb first.")
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        if OLD_TABLE not in connection.introspection.table_names():
+            if verbosity > 0:
+                self.stdout.write("Nothing to convert, %s doesn't exist\n" % OLD_TABLE)
+            return
+
+        #only stock still held by nobody is in flight. The rows of settled
+        #transfers were merged into, or handed over to, real inventory
+        nobody = Contact.by_alias("nobody")
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        held = []
+        if nobody is not None:
+            cursor.execute("SELECT l.stocktransaction_id, s.id, s.product_id, s.stock_amount "
+                           "FROM %s l JOIN %s s ON s.id = l.stock_id WHERE s.seller_id = %%s" % (
+                           qn(OLD_TABLE), qn(Stock._meta.db_table)), [nobody.pk])
+            held = cursor.fetchall()
+        for trans_id, stock_id, product_id, amount in held:
+            TransferLine.objects.create(transaction_id=trans_id, product_id=product_id, quantity=amount)
+        cursor.execute("DROP TABLE %s" % qn(OLD_TABLE))
+        #a raw statement doesn't make commit_on_success commit, and the
+        #drop may be the only change
+        transaction.set_dirty()
+        Stock.objects.filter(pk__in=[h[1] for h in held]).delete()
+
+        if verbosity > 0:
+            pending = StockTransaction.objects.filter(status=StockTransaction.PENDING).count()
+            self.stdout.write("Converted %d held stock rows into transfer lines for %d pending transfers\n" % (
+                len(held), pending))
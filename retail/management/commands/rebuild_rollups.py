@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import F
+from retail.models import Organization, Sale, SaleRollup, Stock, insert_many
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the daily sale rollups from the existing Sale table, one organization at a time."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--chunk-size", dest="chunk_size", type="int", default=5000,
+            help="Number of sales to read, and rollup rows to insert, per query (default 5000)."),
+    )
+
+    def handle_noargs(self, **options):
+        chunk_size = options["chunk_size"]
+        self.verbosity = int(options.get("verbosity", 1))
+
+        sale_count = row_count = 0
+        for org_id in Organization.objects.order_by("id").values_list("id", flat=True):
+            sales, rows = self.rebuild(org_id, chunk_size)
+            sale_count += sales
+            row_count += rows
+
+        if self.verbosity > 0:
+            self.stdout.write("Rolled up %d sales into %d rows\n" % (sale_count, row_count))
+
+    @transaction.commit_on_success
+    def rebuild(self, org_id, chunk_size):
+        """
+        Replace the rollups of one organization, in a transaction of its
+        own. Returns the number of sales read and rollup rows written.
+        """
+        #sales and cancels update their seller's stock before anything
+        #else, so locking the organization's stock first waits for those
+        #under way to commit, and holds off new ones until the rollups
+        #are rewritten. None can be missed or counted twice
+        Stock.objects.filter(seller__organization=org_id).update(stock_amount=F("stock_amount"))
+
+        #read the sales in primary key order, one chunk at a time, so
+        #memory only grows with the number of rollup rows
+        sales = Sale.objects.filter(seller__organization=org_id).order_by("serial").values_list(
+            "serial", "purchase_date", "seller", "product", "region", "purchase_price")
+        totals = {}
+        sale_count = 0
+        last_serial = None
+        while True:
+            chunk = sales
+            if last_serial is not None:
+                chunk = chunk.filter(serial__gt=last_serial)
+            rows = list(chunk[:chunk_size])
+            if not rows:
+                break
+            for serial, purchase_date, seller_id, product_id, region, price in rows:
+                key = (purchase_date.date(), seller_id, product_id, region)
+                count, revenue = totals.get(key, (0, 0))
+                totals[key] = (count + 1, revenue + int(price * 1000))
+            sale_count += len(rows)
+            last_serial = rows[-1][0]
+            if self.verbosity > 1:
+                self.stdout.write("Organization %d: read %d sales\n" % (org_id, sale_count))
+
+        SaleRollup.objects.filter(organization=org_id).delete()
+        rollups = [SaleRollup(day=day, organization_id=org_id, seller_id=seller_id, product_id=product_id,
+                              region=region, sale_count=count, revenue=revenue)
+                   for (day, seller_id, product_id, region), (count, revenue) in totals.iteritems()]
+        for i in range(0, len(rollups), chunk_size):
+            insert_many(SaleRollup, rollups[i:i + chunk_size])
+        return sale_count, len(rollups)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import os
+import time
+from datetime import datetime, timedelta
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from retail.models import ExportJob
+
+
+class Command(NoArgsCommand):
+    help = "Generates pending sales exports in the background."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--once", action="store_true", dest="once", default=False,
+            help="Run the pending exports, then exit instead of polling."),
+        make_option("--interval", dest="interval", type="int", default=10,
+            help="Seconds to wait between polls (default 10)."),
+        make_option("--keep-days", dest="keep_days", type="int", default=7,
+            help="Delete exports older than this many days (default 7)."),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        while True:
+            ExportJob.reset_stale()
+            self.purge(options["keep_days"])
+            for job in ExportJob.objects.filter(status=ExportJob.PENDING).order_by("date_requested"):
+                #another worker may have started it already
+                if not job.claim():
+                    continue
+                job.run()
+                if verbosity > 0:
+                    self.stdout.write("%s (%d rows)\n" % (job, job.rows_written))
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
+
+    def purge(self, keep_days):
+        cutoff = datetime.now() - timedelta(days=keep_days)
+        for job in ExportJob.objects.filter(date_requested__lt=cutoff).exclude(status=ExportJob.RUNNING):
+            if os.path.exists(job.path):
+                os.remove(job.path)
+            job.delete()
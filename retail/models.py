@@ -1,7 +1,57 @@
-from django.db import models
-from django.db.models.signals import post_save
+import os
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import F, Sum
+from django.db.models.signals import post_save, post_delete
 from django.contrib.admin.models import User
-from datetime import datetime
+from datetime import datetime, timedelta
+from retail import caching
+
+def insert_many(model, objects):
+    """
+    Insert ``objects`` of ``model`` with one executemany, without sending
+    save signals or setting their ids. As with QuerySet.update, the
+    rows are committed unless a transaction is being managed, which is
+    marked dirty so that it commits them.
+    """
+    fields = [f for f in model._meta.local_fields if not isinstance(f, models.AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        connection.ops.quote_name(model._meta.db_table),
+        ", ".join(connection.ops.quote_name(f.column) for f in fields),
+        ", ".join(["%s"] * len(fields)))
+    rows = [[f.get_db_prep_save(f.pre_save(o, True), connection=connection) for f in fields] for o in objects]
+    if rows:
+        connection.cursor().executemany(sql, rows)
+        transaction.commit_unless_managed()
+
+@contextmanager
+def commit_or_savepoint():
+    """
+    Like transaction.commit_on_success, unless the caller is already
+    managing a transaction, which commit_on_success would commit or roll
+    back as a whole. The block is then a savepoint of the caller's
+    transaction, where the database has them, and otherwise just part of
+    it, for the caller to commit or roll back.
+    """
+    if not transaction.is_managed():
+        with transaction.commit_on_success():
+            yield
+        return
+    sid = transaction.savepoint()
+    try:
+        yield
+    except:
+        transaction.savepoint_rollback(sid)
+        raise
+    transaction.savepoint_commit(sid)
+
+def can_roll_back_block():
+    """
+    Whether a commit_or_savepoint block that fails leaves nothing behind.
+    """
+    return not transaction.is_managed() or connection.features.uses_savepoints
 
 class Product(models.Model):
     code = models.CharField(max_length=4, \
@@ -10,20 +60,62 @@ class Product(models.Model):
                             help_text=("Short name for use in SMS"));
     full_name = models.CharField(max_length=100,blank=True, null=True)
 
+    #the catalog is small and rarely changes, so every process keeps it in
+    #memory. It's reloaded when a product is saved or deleted here, when
+    #one isn't found, and after CATALOG_TIMEOUT seconds to pick up changes
+    #made by other processes
+    CATALOG_TIMEOUT = getattr(settings, 'RETAIL_CATALOG_TIMEOUT', 60)
+    _catalog = None
+
     def __unicode__(self):
         return self.display_name
 
+    @classmethod
+    def catalog (cls):
+        """
+        Returns a dict of the products by code.
+        """
+        catalog = cls._catalog
+        if catalog is None or catalog[0] < time.time():
+            catalog = (time.time() + cls.CATALOG_TIMEOUT,
+                       dict((p.code, p) for p in cls.objects.order_by('id')))
+            cls._catalog = catalog
+        return catalog[1]
+
+    @classmethod
+    def reset_catalog (cls, **kwargs):
+        cls._catalog = None
+
     @classmethod
     def by_code (cls, code):
-        try:
-            return cls.objects.get(code=code)
-        except models.ObjectDoesNotExist:
-            return None
+        product = cls.catalog().get(code)
+        if product is None:
+            #it may have been added by another process since the catalog
+            #was loaded
+            cls.reset_catalog()
+            product = cls.catalog().get(code)
+        return product
+
+class OutOfStock(Exception):
+    """
+    Raised when a sale is recorded for a product the seller has no stock of.
+    """
+    pass
+
+class TransferContended(Exception):
+    """
+    Raised inside StockTransaction.settle when another process settled
+    some of the same transactions first, to roll back and start over.
+    """
+    pass
 
 class Stock(models.Model): 
     seller       = models.ForeignKey('rapidsms.Contact')
     product      = models.ForeignKey(Product)
     stock_amount = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('seller', 'product')
     
     def __unicode__(self):
         return "%s: %s %ss" % (
@@ -38,6 +130,24 @@ class Stock(models.Model):
         except models.ObjectDoesNotExist:
             return None
 
+    @classmethod
+    def summary (cls, seller, msg=None):
+        """
+        The seller's stock as "5 Ecozoom, 3 Envirofit", read with the
+        product names in one query. When ``msg`` is given the summary is
+        kept on it, so replies to the same message don't read it again;
+        handlers should render it after making their own stock changes.
+        """
+        summaries = getattr(msg, 'stock_summaries', None)
+        if summaries is None:
+            summaries = {}
+            if msg is not None:
+                msg.stock_summaries = summaries
+        if seller.pk not in summaries:
+            stock = cls.objects.filter(seller=seller.pk).order_by('id')
+            summaries[seller.pk] = ", ".join("%s %s" % s for s in stock.values_list('stock_amount', 'product__display_name'))
+        return summaries[seller.pk]
+
 class Sale(models.Model):
     
     ARUSHA = 'A'
@@ -112,16 +222,151 @@ class Sale(models.Model):
         return self.serial
 
     def save(self):
-        #update the seller's revenue total
-        self.seller.cached_revenue += (self.purchase_price * 1000)
-        self.seller.save()
-        #update the seller's stock
-        current_stock = Stock.get_existing(self.seller.alias, self.product.code)
-        current_stock.stock_amount -= 1
-        current_stock.save()
-        #now save the sale itself        
-        super(Sale, self).save()
+        """
+        Records a new sale, taking the stove out of the seller's stock and
+        adding its price to their revenue in the same transaction. Raises
+        OutOfStock if the seller has none left, and IntegrityError if the
+        serial is already registered, leaving everything as it was. A sale
+        that was read from the database (e.g. edited in the admin) is just
+        updated, without touching stock, revenue or the rollups.
+        """
+        #the serial is the primary key, so a new sale already has one
+        if not self._state.adding:
+            super(Sale, self).save()
+            return
+        revenue = int(self.purchase_price * 1000)
+        with commit_or_savepoint():
+            #decrement in the database, so concurrent sales can't both
+            #take the last stove or overwrite each other's counts. Nothing
+            #is taken for a serial that's already registered, so a failed
+            #sale writes nothing even inside a larger transaction
+            taken = Stock.objects.filter(seller=self.seller.pk, product=self.product_id, stock_amount__gt=0)\
+                .extra(where=['NOT EXISTS (SELECT 1 FROM %s WHERE serial = %%s)' % self._meta.db_table],
+                       params=[self.serial])\
+                .update(stock_amount=F('stock_amount') - 1)
+            if not taken:
+                if Sale.objects.filter(serial=self.serial).exists():
+                    raise IntegrityError("Sale %s is already registered" % self.serial)
+                raise OutOfStock(self.product)
+            #cached_revenue is stored on the contact extension's table
+            seller_table = self.seller._meta.get_field('cached_revenue').model
+            seller_table.objects.filter(pk=self.seller.pk).update(cached_revenue=F('cached_revenue') + revenue)
+            self.seller.cached_revenue += revenue
+            #now save the sale itself, never overwriting one with the same serial
+            super(Sale, self).save(force_insert=True)
+            #and count it in the daily rollup and the change log
+            SaleRollup.record(self)
+            SaleChange.record(self, SaleChange.RECORDED)
+        #only invalidate once committed, so a dashboard can't cache the
+        #figures from before the sale under the new version
+        caching.bump(self.seller.organization_id)
+
+    def delete(self):
+        """
+        Deletes the sale, taking it off its rollup (see
+        SaleRollup.sale_deleted), and invalidates the cached figures once
+        that's committed. Stock and revenue are left to the caller, as
+        the cancel command returns them.
+        """
+        self._bump_after_delete = True
+        with commit_or_savepoint():
+            super(Sale, self).delete()
+        caching.bump(self.seller.organization_id)
     
+    @classmethod
+    def check_many (cls, sales):
+        """
+        Checks ``sales`` with one query for the serials already registered,
+        and one for the stock of their sellers. Sales of serials that are
+        registered, or listed twice, and those there isn't enough stock
+        for are rejected. Returns the sales that can be saved, and a
+        (sale, reason) pair for each rejected.
+        """
+        serials = [s.serial for s in sales]
+        registered = set()
+        for i in range(0, len(serials), 500):
+            registered.update(cls.objects.filter(serial__in=serials[i:i + 500]).values_list('serial', flat=True))
+        sellers = set(s.seller.pk for s in sales)
+        stock = dict(((seller, product), amount) for seller, product, amount in
+                     Stock.objects.filter(seller__in=sellers).values_list('seller', 'product', 'stock_amount'))
+
+        accepted, rejected = [], []
+        for sale in sales:
+            key = (sale.seller.pk, sale.product_id)
+            if sale.serial in registered:
+                rejected.append((sale, "already registered"))
+            elif stock.get(key, 0) < 1:
+                rejected.append((sale, "No %s in stock" % sale.product.code))
+            else:
+                stock[key] -= 1
+                registered.add(sale.serial)
+                accepted.append(sale)
+        return accepted, rejected
+
+    @classmethod
+    def save_many (cls, sales):
+        """
+        Records ``sales`` as save() would one at a time, with a few queries
+        for the lot, rejecting those check_many() does. Returns the sales
+        saved, and a (sale, reason) pair for each rejected. In a transaction
+        the caller manages, on a database without savepoints, a sale taken
+        by someone else since the check raises OutOfStock or IntegrityError
+        instead, and the caller's transaction has to be rolled back.
+        """
+        accepted, rejected = cls.check_many(sales)
+        try:
+            cls._save_together(accepted)
+        except (OutOfStock, IntegrityError):
+            #someone else sold from the same stock, or registered one of
+            #the serials, since it was checked. Save them one at a time,
+            #unless what was written so far can't be undone, as in a
+            #transaction of the caller's without savepoints
+            if not can_roll_back_block():
+                raise
+            saved = []
+            for sale in accepted:
+                try:
+                    sale.save()
+                    saved.append(sale)
+                except OutOfStock:
+                    rejected.append((sale, "No %s in stock" % sale.product.code))
+                except IntegrityError:
+                    rejected.append((sale, "already registered"))
+            return saved, rejected
+        caching.bump(*set(s.seller.organization_id for s in accepted))
+        return accepted, rejected
+
+    @classmethod
+    def _save_together (cls, sales):
+        counts, revenues, rollups = {}, {}, {}
+        for sale in sales:
+            revenue = int(sale.purchase_price * 1000)
+            key = (sale.seller.pk, sale.product_id)
+            counts[key] = counts.get(key, 0) + 1
+            revenues[sale.seller.pk] = revenues.get(sale.seller.pk, 0) + revenue
+            key = (sale.purchase_date.date(), sale.seller.organization_id, sale.seller.pk, sale.product_id, sale.region)
+            count, total = rollups.get(key, (0, 0))
+            rollups[key] = (count + 1, total + revenue)
+        if not sales:
+            return
+        with commit_or_savepoint():
+            for (seller_id, product_id), count in counts.items():
+                taken = Stock.objects.filter(seller=seller_id, product=product_id, stock_amount__gte=count)\
+                    .update(stock_amount=F('stock_amount') - count)
+                if not taken:
+                    raise OutOfStock(product_id)
+            seller_table = sales[0].seller._meta.get_field('cached_revenue').model
+            for seller_id, revenue in revenues.items():
+                seller_table.objects.filter(pk=seller_id).update(cached_revenue=F('cached_revenue') + revenue)
+            insert_many(cls, sales)
+            for (day, org_id, seller_id, product_id, region), (count, revenue) in rollups.items():
+                SaleRollup.add(day, org_id, seller_id, product_id, region, count, revenue)
+            now = datetime.now()
+            insert_many(SaleChange, [SaleChange(sale=s, serial=s.serial, organization_id=s.seller.organization_id,
+                                                action=SaleChange.RECORDED, date=now) for s in sales])
+        for sale in sales:
+            sale.seller.cached_revenue += int(sale.purchase_price * 1000)
+
     @classmethod
     def by_serial (cls, serial):
         try:
@@ -129,6 +374,132 @@ class Sale(models.Model):
         except models.ObjectDoesNotExist:
             return None
 
+    @classmethod
+    def by_serials (cls, serials):
+        """
+        The sales of ``serials`` that are registered, with their product and
+        seller, by serial.
+        """
+        serials = [s.upper() for s in serials]
+        found = {}
+        for i in range(0, len(serials), 500):
+            for sale in cls.objects.filter(serial__in=serials[i:i + 500]).select_related('product', 'seller'):
+                found[sale.serial] = sale
+        return found
+
+class SaleRollup(models.Model):
+    """
+    Daily sale totals per organization, seller, product and region. Rows
+    are kept up to date as sales are saved and canceled, so dashboards
+    can read totals without scanning the whole Sale table.
+    """
+    day          = models.DateField()
+    organization = models.ForeignKey('Organization')
+    seller       = models.ForeignKey('rapidsms.Contact')
+    product      = models.ForeignKey(Product)
+    region       = models.CharField(choices = Sale.REGION_CHOICES, max_length=1)
+    sale_count   = models.IntegerField(default=0)
+    revenue      = models.IntegerField(default=0, help_text="Revenue in Tsh")
+
+    class Meta:
+        unique_together = ('day', 'organization', 'seller', 'product', 'region')
+
+    def __unicode__(self):
+        return "%s %s %s: %s" % (
+            self.day,
+            self.seller.alias,
+            self.product.display_name,
+            self.sale_count)
+
+    @classmethod
+    def record (cls, sale, count=1):
+        """
+        Add ``count`` sales (negative to remove them) to the rollup row
+        for ``sale``. Must be called inside the transaction that saves or
+        deletes the sale itself.
+        """
+        cls.add(sale.purchase_date.date(), sale.seller.organization_id, sale.seller_id,
+                sale.product_id, sale.region, count, int(sale.purchase_price * 1000) * count)
+
+    @classmethod
+    def sale_deleted (cls, sender, instance, **kwargs):
+        """
+        Take a deleted sale off its rollup row, wherever it was deleted
+        from (the cancel command, or the admin).
+        """
+        cls.record(instance, -1)
+        #Sale.delete invalidates the cache once the delete is committed.
+        #Nothing runs after a queryset's delete, so those invalidate now
+        if not getattr(instance, '_bump_after_delete', False):
+            caching.bump(instance.seller.organization_id)
+
+    @classmethod
+    def add (cls, day, org_id, seller_id, product_id, region, count, revenue):
+        """
+        Add ``count`` sales worth ``revenue`` to a rollup row.
+        """
+        existing = cls.objects.filter(day=day, organization=org_id, seller=seller_id,
+                                      product=product_id, region=region)
+        if existing.update(sale_count=F('sale_count') + count, revenue=F('revenue') + revenue):
+            return
+        #first sale for this row. another worker may create it at the same
+        #time, in which case fall back to updating theirs
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(day=day, organization_id=org_id, seller_id=seller_id,
+                               product_id=product_id, region=region,
+                               sale_count=count, revenue=revenue)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            existing.update(sale_count=F('sale_count') + count, revenue=F('revenue') + revenue)
+
+class SaleChange(models.Model):
+    """
+    An append-only log of recorded and canceled sales, used for the
+    incremental sales feed. The id of the last change seen is the feed's
+    cursor. Canceled sales are logged as tombstones carrying only their
+    serial, and the log entry of the original sale loses its link.
+    """
+
+    CANCELLED = 0
+    RECORDED = 1
+
+    ACTION_CHOICES = (
+        (CANCELLED, 'cancel'),
+        (RECORDED, 'sale'),
+    )
+
+    sale         = models.ForeignKey(Sale, null=True, blank=True, on_delete=models.SET_NULL)
+    serial       = models.CharField(max_length=14)
+    organization = models.ForeignKey('Organization')
+    action       = models.IntegerField(choices = ACTION_CHOICES)
+    date         = models.DateTimeField()
+
+    def __unicode__(self):
+        return "%s %s" % (self.get_action_display(), self.serial)
+
+    @classmethod
+    def record (cls, sale, action):
+        return cls.objects.create(sale=(action == cls.RECORDED) and sale or None,
+                                  serial=sale.serial, action=action, date=datetime.now(),
+                                  organization_id=sale.seller.organization_id)
+
+    #ids are handed out before the sales logging them are committed, so a
+    #change can show up after changes with higher ids. The feed's cursor
+    #only moves past changes logged this many seconds ago, by which time
+    #every transaction logging a lower id is assumed to have committed
+    FEED_LAG = getattr(settings, 'RETAIL_FEED_LAG', 60)
+
+    @classmethod
+    def settled_id (cls):
+        """
+        The id of the last change logged over FEED_LAG seconds ago, or 0.
+        """
+        cutoff = datetime.now() - timedelta(seconds=cls.FEED_LAG)
+        ids = cls.objects.filter(date__lte=cutoff).order_by('-id').values_list('id', flat=True)[:1]
+        return ids and ids[0] or 0
+
 class StockTransaction(models.Model):
 
     CANCELLED = 3
@@ -143,7 +514,6 @@ class StockTransaction(models.Model):
         (REJECTED, 'Rejected'),
     )
     
-    to_transfer = models.ManyToManyField(Stock)
     initiator = models.ForeignKey('rapidsms.Contact', related_name='stocktransaction_initiators')
     recipient = models.ForeignKey('rapidsms.Contact', related_name='stocktransaction_recipients')
     status = models.IntegerField(choices = STATUS_CHOICES, max_length=1)
@@ -163,6 +533,120 @@ class StockTransaction(models.Model):
         except models.ObjectDoesNotExist:
             return None
 
+    @classmethod
+    def start (cls, initiator, recipient, items):
+        """
+        Sets aside ``items``, a list of (product, quantity) pairs, from the
+        initiator's stock for a transfer to ``recipient``. Each product is
+        taken with one conditional update, and products the initiator
+        doesn't have enough of are left out. Returns the new pending
+        transaction, or None if nothing could be sent, and the list of
+        products left out.
+        """
+        stockouts = []
+        lines = []
+        with transaction.commit_on_success():
+            for product, quantity in items:
+                taken = Stock.objects.filter(seller=initiator.pk, product=product.id, stock_amount__gte=quantity)\
+                    .update(stock_amount=F('stock_amount') - quantity)
+                if taken:
+                    lines.append(TransferLine(product=product, quantity=quantity))
+                else:
+                    stockouts.append(product)
+            if not lines:
+                return None, stockouts
+            trans = cls.objects.create(initiator=initiator, recipient=recipient,
+                                       status=cls.PENDING, date_initiated=datetime.now())
+            for line in lines:
+                line.transaction = trans
+                line.save()
+        caching.bump(initiator.organization_id)
+        return trans, stockouts
+
+    #times settle() reads the pending transactions again after losing
+    #some of them to another process
+    SETTLE_ATTEMPTS = 3
+
+    @classmethod
+    def settle (cls, pending, status):
+        """
+        Resolves the transactions in ``pending`` that are still pending with
+        ``status``, all in one database transaction. Accepted stock goes to
+        the recipient and anything else back to the initiator, added to
+        their stock of each product in a single update. Returns the
+        transactions settled.
+        """
+        for attempt in range(cls.SETTLE_ATTEMPTS):
+            try:
+                settled = cls._settle(pending, status)
+                break
+            except TransferContended:
+                settled = []
+        orgs = set()
+        for t in settled:
+            orgs.update([t.initiator.organization_id, t.recipient.organization_id])
+        caching.bump(*orgs)
+        return settled
+
+    @classmethod
+    def _settle (cls, pending, status):
+        with transaction.commit_on_success():
+            settled = list(pending.filter(status=cls.PENDING).select_related('initiator', 'recipient'))
+            if not settled:
+                return settled
+            #claim them before crediting any stock, so two replies handled
+            #at once can't both settle the same transaction. If another
+            #process got some first, start over from what's left
+            now = datetime.now()
+            claimed = cls.objects.filter(pk__in=[t.id for t in settled], status=cls.PENDING)\
+                .update(status=status, date_resolved=now)
+            if claimed < len(settled):
+                raise TransferContended()
+            owners = {}
+            for t in settled:
+                owners[t.id] = (status == cls.ACCEPTED) and t.recipient_id or t.initiator_id
+                t.status, t.date_resolved = status, now
+            totals = {}
+            for trans_id, product, quantity in TransferLine.objects.filter(transaction__in=owners.keys())\
+                    .values_list('transaction', 'product', 'quantity'):
+                key = (owners[trans_id], product)
+                totals[key] = totals.get(key, 0) + quantity
+
+            #add to each owner's stock row for the product, creating the
+            #few that don't exist yet
+            rows = dict(((seller, product), stock_id) for stock_id, seller, product in
+                        Stock.objects.filter(seller__in=set(owners.values()), product__in=set(k[1] for k in totals))
+                                     .values_list('id', 'seller', 'product'))
+            added = {}
+            for (seller, product), quantity in totals.items():
+                if (seller, product) in rows:
+                    added[rows[(seller, product)]] = quantity
+                else:
+                    Stock.objects.create(seller_id=seller, product_id=product, stock_amount=quantity)
+            if added:
+                qn = connection.ops.quote_name
+                params = []
+                for item in added.items():
+                    params.extend(item)
+                connection.cursor().execute("UPDATE %s SET %s = %s + CASE %s %s ELSE 0 END WHERE %s IN (%s)" % (
+                    qn(Stock._meta.db_table), qn('stock_amount'), qn('stock_amount'), qn('id'),
+                    ' '.join(["WHEN %s THEN %s"] * len(added)), qn('id'), ', '.join(["%s"] * len(added))),
+                    params + added.keys())
+        return settled
+
+class TransferLine(models.Model):
+    """
+    The quantity of one product in a stock transfer. The stock is out of
+    the initiator's inventory while the transfer is pending, and in no
+    one's.
+    """
+    transaction = models.ForeignKey(StockTransaction, related_name='lines')
+    product     = models.ForeignKey(Product)
+    quantity    = models.IntegerField()
+
+    def __unicode__(self):
+        return "%s %s" % (self.quantity, self.product.display_name)
+
 class Organization(models.Model):
     code = models.CharField(max_length=4, \
                             help_text="Organization abbreviation, max 4 characters")
@@ -187,8 +671,366 @@ class UserProfile(models.Model):
     def __str__(self):
         return "Profile for %s" % self.user
 
+class ExportJob(models.Model):
+    """
+    A sales export generated in the background by the run_exports
+    command, into a file under settings.RETAIL_EXPORT_DIR. Asking for the
+    same export again within RETAIL_EXPORT_TTL seconds reuses the job.
+    """
+
+    FAILED = 3
+    DONE = 2
+    RUNNING = 1
+    PENDING = 0
+
+    STATUS_CHOICES = (
+        (FAILED, 'Failed'),
+        (DONE, 'Done'),
+        (RUNNING, 'Running'),
+        (PENDING, 'Pending'),
+    )
+
+    #rows written between progress updates
+    PROGRESS_EVERY = 2000
+
+    #a job running for longer than this is taken to have lost its worker
+    STALE_AFTER = getattr(settings, 'RETAIL_JOB_STALE_AFTER', 60 * 60)
+
+    organization = models.ForeignKey(Organization, blank=True, null=True,
+                                     help_text="Leave blank to export every organization")
+    start_date = models.DateField(blank=True, null=True)
+    end_date = models.DateField(blank=True, null=True)
+    compressed = models.BooleanField(default=False, help_text="Gzip the export")
+    requested_by = models.ForeignKey(User, blank=True, null=True)
+    status = models.IntegerField(choices = STATUS_CHOICES, default=PENDING)
+    total_rows = models.IntegerField(default=0)
+    rows_written = models.IntegerField(default=0)
+    date_requested = models.DateTimeField()
+    date_started = models.DateTimeField(null=True, blank=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return "Export %s: %s" % (self.id, self.get_status_display())
+
+    @property
+    def file_name(self):
+        return "sales_export_%s.csv%s" % (self.id, self.compressed and ".gz" or "")
+
+    @property
+    def path(self):
+        return os.path.join(settings.RETAIL_EXPORT_DIR, self.file_name)
+
+    @property
+    def progress(self):
+        if self.status == self.DONE:
+            return 100
+        if not self.total_rows:
+            return 0
+        return int(self.rows_written * 100 / self.total_rows)
+
+    @classmethod
+    def request (cls, organization=None, start_date=None, end_date=None, compressed=False, user=None):
+        """
+        Return a job for the given export, reusing a recent one with the
+        same parameters if it hasn't failed.
+        """
+        cls.reset_stale()
+        cutoff = datetime.now() - timedelta(seconds=settings.RETAIL_EXPORT_TTL)
+        recent = cls.objects.filter(organization=organization, start_date=start_date, end_date=end_date,
+                                    compressed=compressed, date_requested__gte=cutoff)\
+            .exclude(status=cls.FAILED).order_by('-date_requested')
+        for job in recent[:1]:
+            return job
+        return cls.objects.create(organization=organization, start_date=start_date, end_date=end_date,
+                                  compressed=compressed, requested_by=user, date_requested=datetime.now())
+
+    @classmethod
+    def reset_stale (cls):
+        """
+        Put back in the queue the jobs that started over STALE_AFTER
+        seconds ago and are still running, as their worker must have
+        died. The export is written again from the start.
+        """
+        cutoff = datetime.now() - timedelta(seconds=cls.STALE_AFTER)
+        return cls.objects.filter(status=cls.RUNNING, date_started__lt=cutoff)\
+            .update(status=cls.PENDING, date_started=None, rows_written=0)
+
+    def sales(self):
+        sales = Sale.objects.all()
+        if self.organization_id:
+            sales = sales.filter(seller__organization=self.organization_id)
+        if self.start_date:
+            sales = sales.filter(purchase_date__gte=self.start_date)
+        if self.end_date:
+            sales = sales.filter(purchase_date__lt=self.end_date + timedelta(days=1))
+        return sales
+
+    def claim(self):
+        """
+        Mark this job as running, unless another worker got there first.
+        """
+        self.date_started = datetime.now()
+        claimed = ExportJob.objects.filter(id=self.id, status=self.PENDING)\
+            .update(status=self.RUNNING, date_started=self.date_started)
+        if claimed:
+            self.status = self.RUNNING
+        return bool(claimed)
+
+    def run(self):
+        """
+        Write the export to a temporary file, recording progress as it
+        goes, and move it into place once complete.
+        """
+        from retail import export
+        jobs = ExportJob.objects.filter(id=self.id)
+        sales = self.sales()
+        self.total_rows = sales.count()
+        jobs.update(total_rows=self.total_rows)
+
+        def counted(rows):
+            for row in rows:
+                yield row
+                self.rows_written += 1
+                if self.rows_written % self.PROGRESS_EVERY == 0:
+                    jobs.update(rows_written=self.rows_written)
+
+        if not os.path.isdir(settings.RETAIL_EXPORT_DIR):
+            os.makedirs(settings.RETAIL_EXPORT_DIR)
+        partial = self.path + ".part"
+        try:
+            chunks = export.csv_lines(counted(export.sale_rows(sales)))
+            if self.compressed:
+                chunks = export.gzip_chunks(chunks)
+            f = open(partial, "wb")
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+            finally:
+                f.close()
+            os.rename(partial, self.path)
+        except Exception, err:
+            if os.path.exists(partial):
+                os.remove(partial)
+            self.status = self.FAILED
+            self.error = unicode(err)
+        else:
+            self.status = self.DONE
+        self.date_finished = datetime.now()
+        jobs.update(status=self.status, rows_written=self.rows_written,
+                    date_finished=self.date_finished, error=self.error)
+
+class ImportJob(models.Model):
+    """
+    A CSV file of sales uploaded on the Sales tab, and imported in the
+    background by the run_imports command. The rows that couldn't be
+    imported are written to a second file, with the reason for each.
+    """
+
+    FAILED = ExportJob.FAILED
+    DONE = ExportJob.DONE
+    RUNNING = ExportJob.RUNNING
+    PENDING = ExportJob.PENDING
+
+    STATUS_CHOICES = ExportJob.STATUS_CHOICES
+
+    STALE_AFTER = ExportJob.STALE_AFTER
+
+    organization = models.ForeignKey(Organization, blank=True, null=True,
+                                     help_text="Blank if sellers of any organization can be imported")
+    file_name = models.CharField(max_length=100, help_text="Name of the uploaded file")
+    requested_by = models.ForeignKey(User, blank=True, null=True)
+    status = models.IntegerField(choices = STATUS_CHOICES, default=PENDING)
+    rows_read = models.IntegerField(default=0)
+    rows_imported = models.IntegerField(default=0)
+    rows_rejected = models.IntegerField(default=0)
+    date_requested = models.DateTimeField()
+    date_started = models.DateTimeField(null=True, blank=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return "Import %s: %s" % (self.id, self.get_status_display())
+
+    @property
+    def path(self):
+        return os.path.join(settings.RETAIL_IMPORT_DIR, "sales_import_%s.csv" % self.id)
+
+    @property
+    def rejected_file_name(self):
+        return "sales_import_%s_rejected.csv" % self.id
+
+    @property
+    def rejected_path(self):
+        return os.path.join(settings.RETAIL_IMPORT_DIR, self.rejected_file_name)
+
+    @classmethod
+    def upload (cls, f, organization=None, user=None):
+        """
+        Start a job for the uploaded file ``f``, copying it to disk a chunk
+        at a time.
+        """
+        job = cls.objects.create(organization=organization, file_name=f.name[:100], requested_by=user,
+                                 date_requested=datetime.now())
+        if not os.path.isdir(settings.RETAIL_IMPORT_DIR):
+            os.makedirs(settings.RETAIL_IMPORT_DIR)
+        out = open(job.path, "wb")
+        try:
+            for chunk in f.chunks():
+                out.write(chunk)
+        finally:
+            out.close()
+        return job
+
+    @classmethod
+    def fail_stale (cls):
+        """
+        Mark as failed the jobs that started over STALE_AFTER seconds ago
+        and are still running, as their worker must have died. They
+        aren't run again, as the rows imported before it died would then
+        be rejected as already registered.
+        """
+        cutoff = datetime.now() - timedelta(seconds=cls.STALE_AFTER)
+        return cls.objects.filter(status=cls.RUNNING, date_started__lt=cutoff)\
+            .update(status=cls.FAILED, date_finished=datetime.now(),
+                    error="Stopped while running. The rows counted as imported were, the others weren't.")
+
+    def claim(self):
+        """
+        Mark this job as running, unless another worker got there first.
+        """
+        self.date_started = datetime.now()
+        claimed = ImportJob.objects.filter(id=self.id, status=self.PENDING)\
+            .update(status=self.RUNNING, date_started=self.date_started)
+        if claimed:
+            self.status = self.RUNNING
+        return bool(claimed)
+
+    def run(self):
+        """
+        Import the file, a chunk of rows at a time, recording progress
+        after each chunk.
+        """
+        from retail import imports
+        jobs = ImportJob.objects.filter(id=self.id)
+
+        def progress(read, imported, rejected):
+            self.rows_read, self.rows_imported, self.rows_rejected = read, imported, rejected
+            jobs.update(rows_read=read, rows_imported=imported, rows_rejected=rejected)
+
+        f = open(self.path, "rU")
+        rejected = open(self.rejected_path, "wb")
+        try:
+            imports.import_sales(f, rejected, self.organization_id, progress=progress)
+        except Exception, err:
+            self.status = self.FAILED
+            self.error = unicode(err)
+        else:
+            self.status = self.DONE
+        finally:
+            f.close()
+            rejected.close()
+        self.date_finished = datetime.now()
+        jobs.update(status=self.status, date_finished=self.date_finished, error=self.error)
+
+class HandlerTiming(models.Model):
+    """
+    Hourly totals of the time and queries each SMS command took, with a
+    histogram of how long its messages took to handle. retail.timing
+    collects them in memory and adds them here every so often.
+    """
+
+    #upper bounds of the histogram buckets, in milliseconds
+    BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500)
+
+    keyword  = models.CharField(max_length=20)
+    hour     = models.DateTimeField()
+    messages = models.IntegerField(default=0)
+    total_ms = models.IntegerField(default=0)
+    db_ms    = models.IntegerField(default=0)
+    queries  = models.IntegerField(default=0)
+    ms_10    = models.IntegerField(default=0)
+    ms_25    = models.IntegerField(default=0)
+    ms_50    = models.IntegerField(default=0)
+    ms_100   = models.IntegerField(default=0)
+    ms_250   = models.IntegerField(default=0)
+    ms_500   = models.IntegerField(default=0)
+    ms_1000  = models.IntegerField(default=0)
+    ms_2500  = models.IntegerField(default=0)
+    ms_more  = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('keyword', 'hour')
+
+    def __unicode__(self):
+        return "%s %s: %s" % (self.hour, self.keyword, self.messages)
+
+    @classmethod
+    def bucket_fields (cls):
+        return ["ms_%d" % b for b in cls.BUCKETS] + ["ms_more"]
+
+    @classmethod
+    def record (cls, keyword, hour, totals):
+        """
+        Add ``totals``, a dict of counts by field name, to the row for
+        ``keyword`` and ``hour``.
+        """
+        existing = cls.objects.filter(keyword=keyword, hour=hour)
+        added = dict((name, F(name) + value) for name, value in totals.items())
+        if existing.update(**added):
+            return
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(keyword=keyword, hour=hour, **totals)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            existing.update(**added)
+
+    @classmethod
+    def summary (cls, since):
+        """
+        Totals for each keyword since ``since``, slowest first, with the
+        bucket each percentile of the messages' times falls in.
+        """
+        fields = ['messages', 'total_ms', 'db_ms', 'queries'] + cls.bucket_fields()
+        rows = cls.objects.filter(hour__gte=since).values('keyword')\
+            .annotate(*[Sum(f) for f in fields]).order_by()
+        labels = ["under %d ms" % b for b in cls.BUCKETS] + ["over %d ms" % cls.BUCKETS[-1]]
+        summary = []
+        for row in rows:
+            messages = row['messages__sum']
+            if not messages:
+                continue
+            counts = [row[f + '__sum'] for f in cls.bucket_fields()]
+
+            def percentile(q):
+                seen = 0
+                for label, count in zip(labels, counts):
+                    seen += count
+                    if seen >= q * messages:
+                        return label
+
+            summary.append({
+                'keyword': row['keyword'],
+                'messages': messages,
+                'avg_ms': row['total_ms__sum'] / messages,
+                'avg_db_ms': row['db_ms__sum'] / messages,
+                'avg_queries': float(row['queries__sum']) / messages,
+                'total_ms': row['total_ms__sum'],
+                'p50': percentile(0.50),
+                'p95': percentile(0.95),
+                'p99': percentile(0.99),
+            })
+        summary.sort(key=lambda s: -s['total_ms'])
+        return summary
+
 def create_user_profile(sender, instance, created, **kwargs):  
     if created:  
        profile, created = UserProfile.objects.get_or_create(user=instance) 
 
 post_save.connect(create_user_profile, sender=User)
+
+post_save.connect(Product.reset_catalog, sender=Product, dispatch_uid='retail.product_catalog')
+post_delete.connect(Product.reset_catalog, sender=Product, dispatch_uid='retail.product_catalog')
+post_delete.connect(SaleRollup.sale_deleted, sender=Sale, dispatch_uid='retail.sale_rollup')
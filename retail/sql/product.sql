@@ -0,0 +1,2 @@
+-- Stock.get_existing finds the product by its code
+CREATE INDEX retail_product_code ON retail_product (code);
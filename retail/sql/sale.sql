@@ -0,0 +1,4 @@
+-- a seller's sales by date, for the contact summary on the registration tab
+CREATE INDEX retail_sale_seller_date ON retail_sale (seller_id, purchase_date);
+-- the sales export and feed read sales in (purchase_date, serial) order
+CREATE INDEX retail_sale_date_serial ON retail_sale (purchase_date, serial);
@@ -0,0 +1,4 @@
+-- the dashboard sums an organization's rollups over a range of days
+CREATE INDEX retail_salerollup_org_day ON retail_salerollup (organization_id, day);
+-- PerformanceTable sums each seller's rollups
+CREATE INDEX retail_salerollup_seller_day ON retail_salerollup (seller_id, day);
@@ -0,0 +1,4 @@
+-- yes/no replies settle the recipient's pending transfers, and
+-- "restock cancel" the initiator's
+CREATE INDEX retail_stocktransaction_recipient_status ON retail_stocktransaction (recipient_id, status);
+CREATE INDEX retail_stocktransaction_initiator_status ON retail_stocktransaction (initiator_id, status);
@@ -1,23 +1,587 @@
 """
-This file demonstrates two different styles of tests (one doctest and one
-unittest). These will both pass when you run "manage.py test".
-
-Replace these with more appropriate tests for your application.
+Query budgets for the SMS commands and the busiest pages. Each test
+fails if handling a message, or rendering a page, runs more queries than
+it does today, so an accidental query per row (or per seller, or per
+product) shows up here rather than on the router.
 """
 
+import csv
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Sum
+from django.db.models.signals import post_delete
 from django.test import TestCase
+from django.test.client import RequestFactory
+
+import rapidsms.router
+from rapidsms.router import Router
+from rapidsms.models import Backend, Connection, Contact
+
+from retail.models import Organization, Product, Stock, Sale, OutOfStock, SaleRollup, StockTransaction, SaleChange, HandlerTiming, ExportJob, ImportJob
+from retail import caching, export, grammar, timing
+from pikwa.tables import SaleTable, with_performance
+from pikwa.forms import SaleGridFormSet
+
+BACKEND = "message_tester"
+
+#the dataset the page budgets are measured against
+SELLERS = 5
+SALES = 40
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Builds two organizations with a manager and a few sellers, two
+    products and a fixed number of sales, and a router that handles
+    messages synchronously through the bucket backend.
+    """
+
+    def setUp(self):
+        cache.clear()
+        Product.reset_catalog()
+
+        self.org = Organization.objects.create(code="ORG", display_name="Org", full_name="Org Full")
+        self.other_org = Organization.objects.create(code="OT", display_name="Other", full_name="Other Full")
+        self.ecozoom = Product.objects.create(code="EC", display_name="Ecozoom", full_name="Ecozoom stove")
+        self.envirofit = Product.objects.create(code="EF", display_name="Envirofit", full_name="Envirofit stove")
+        backend, created = Backend.objects.get_or_create(name=BACKEND)
+
+        self.sellers = []
+        self.identities = {}
+        for i in range(SELLERS):
+            seller = Contact.objects.create(name="Seller %d" % i, alias="s%d" % i, role=(i == 0) and 1 or 0,
+                                            organization=(i < SELLERS - 1) and self.org or self.other_org)
+            Connection.objects.create(backend=backend, identity="07550000%02d" % i, contact=seller)
+            self.identities[seller.pk] = "07550000%02d" % i
+            for product in (self.ecozoom, self.envirofit):
+                Stock.objects.create(seller=seller, product=product, stock_amount=100)
+            self.sellers.append(seller)
+        self.manager = self.sellers[0]
+
+        now = datetime.now()
+        for i in range(SALES):
+            product = (self.ecozoom, self.envirofit)[i % 2]
+            Sale(serial="%s%07d" % (product.code, i), product=product, seller=self.sellers[i % SELLERS],
+                 purchase_date=now - timedelta(days=i % 60), purchase_price=Decimal("10.00"),
+                 fname="Ann", lname="Bee", pri_phone="0712345678", region="A", description="Village").save()
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
+        user = User.objects.create_user("manager", "manager@example.com", "secret")
+        profile = user.get_profile()
+        profile.organization = self.org
+        profile.save()
+        staff = User.objects.create_user("staff", "staff@example.com", "secret")
+        staff.is_staff = True
+        staff.save()
+        profile = staff.get_profile()
+        profile.organization = self.org
+        profile.save()
+
+        #Contact.message needs the global router to be running
+        self.real_router = rapidsms.router.router
+        self.router = rapidsms.router.router = Router()
+        self.router.add_app("rapidsms.contrib.handlers")
+        self.backend = self.router.add_backend(BACKEND, "rapidsms.backends.bucket")
+        self.backend.bucket = []
+        for app in self.router.apps:
+            app.start()
+        self.router.running = True
+
+    def tearDown(self):
+        self.router.running = False
+        rapidsms.router.router = self.real_router
+
+    def stock(self, seller, product):
+        return Stock.objects.get(seller=seller, product=product).stock_amount
+
+    def assertMaxQueries(self, num, func, *args, **kwargs):
+        """
+        Calls ``func``, failing if it runs more than ``num`` queries.
         """
-        Tests that 1 + 1 always equals 2.
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        connection.queries = []
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+        queries = connection.queries
+        self.assertTrue(len(queries) <= num, "%d queries run, at most %d expected:\n%s" % (
+            len(queries), num, "\n".join(q["sql"] for q in queries)))
+        return result
+
+    def send(self, identity, text):
         """
-        self.failUnlessEqual(1 + 1, 2)
+        Handles ``text`` as if ``identity`` had sent it, and returns the
+        text of every message sent in reply.
+        """
+        sent = len(self.backend.bucket)
+        self.router.incoming(self.backend.message(identity, text))
+        return [msg.text for msg in self.backend.bucket[sent:]]
+
+    def assertBudget(self, num, contact, text, reply):
+        """
+        Sends ``text`` from ``contact``, checking that it runs at most
+        ``num`` queries and that a reply contains ``reply``.
+        """
+        replies = self.assertMaxQueries(num, self.send, self.identities[contact.pk], text)
+        self.assertTrue([r for r in replies if reply in r], "%r not in replies to %r: %r" % (reply, text, replies))
+        return replies
+
+
+class CommandBudgetTest(QueryBudgetTestCase):
+
+    def test_sale(self):
+        stock = self.stock(self.sellers[1], self.ecozoom)
+        self.assertBudget(11, self.sellers[1], "sale EC9000001 john smith 0712345678 25 A village", "registered")
+        self.assertEqual(self.stock(self.sellers[1], self.ecozoom), stock - 1)
+
+    def test_sale_out_of_stock(self):
+        Stock.objects.filter(seller=self.sellers[1]).update(stock_amount=0)
+        self.assertBudget(7, self.sellers[1], "sale EC9000001 john smith 0712345678 25 A village", "No EC in stock")
+
+    def test_sales(self):
+        stock = self.stock(self.sellers[1], self.ecozoom)
+        replies = self.assertBudget(15, self.sellers[1], "sales EC9000001 john smith 0712345678 25 A village; "
+                                    "EC9000002 ann bee 0712345678 30 B town\nEF0000001 ann bee 0712345678 30 B town; "
+                                    "EC9000003 ann", "2 sales registered")
+        self.assertEqual(len(replies), 1)
+        self.assertTrue("EF0000001 already registered" in replies[0])
+        self.assertTrue("EC9000003 missing" in replies[0])
+        self.assertEqual(self.stock(self.sellers[1], self.ecozoom), stock - 2)
+        self.assertEqual(Sale.objects.filter(serial__startswith="EC9").count(), 2)
+
+    def test_cancel(self):
+        serial = Sale.objects.filter(seller=self.sellers[1])[0].serial
+        self.assertBudget(14, self.sellers[1], "cancel %s" % serial, "canceled")
+        self.assertFalse(Sale.objects.filter(serial=serial).exists())
+
+    def test_restock(self):
+        self.assertBudget(18, self.manager, "restock s1 5ec 3ef", "sent to s1")
+        self.assertEqual(StockTransaction.objects.get().lines.count(), 2)
+
+    def test_restock_same_product_twice(self):
+        stock = self.stock(self.manager, self.ecozoom)
+        self.assertBudget(18, self.manager, "restock s1 5ec 3ec", "8 Ecozoom sent to s1")
+        self.assertEqual(StockTransaction.objects.get().lines.get().quantity, 8)
+        self.assertEqual(self.stock(self.manager, self.ecozoom), stock - 8)
+        Stock.objects.filter(seller=self.manager, product=self.ecozoom).update(stock_amount=6)
+        self.assertBudget(18, self.manager, "restock s1 5ec 3ec", "EC out of stock")
+        self.assertEqual(self.stock(self.manager, self.ecozoom), 6)
+
+    def test_restock_cancel(self):
+        stock = self.stock(self.manager, self.ecozoom)
+        self.send(self.identities[self.manager.pk], "restock s1 5ec 3ef")
+        self.assertBudget(10, self.manager, "restock cancel", "All pending transfers canceled")
+        self.assertEqual(self.stock(self.manager, self.ecozoom), stock)
+
+    def test_accept(self):
+        stock = self.stock(self.sellers[1], self.ecozoom)
+        self.send(self.identities[self.manager.pk], "restock s1 5ec 3ef")
+        self.assertBudget(18, self.sellers[1], "yes", "done")
+        self.assertEqual(self.stock(self.sellers[1], self.ecozoom), stock + 5)
+
+    def test_reject(self):
+        stock = self.stock(self.manager, self.ecozoom)
+        self.send(self.identities[self.manager.pk], "restock s1 5ec 3ef")
+        self.assertBudget(18, self.sellers[1], "no", "rejected")
+        self.assertEqual(self.stock(self.manager, self.ecozoom), stock)
+
+    def test_reject_n(self):
+        stock = self.stock(self.manager, self.ecozoom)
+        self.send(self.identities[self.manager.pk], "restock s1 5ec 3ef")
+        self.assertBudget(18, self.sellers[1], "n", "rejected")
+        self.assertEqual(self.stock(self.manager, self.ecozoom), stock)
+        self.assertBudget(10, self.manager, "n 10ec", "added")
+        self.assertEqual(self.stock(self.manager, self.ecozoom), stock + 10)
+
+    def test_stock(self):
+        self.assertBudget(5, self.sellers[1], "stock", "Stock for s1")
+        self.assertBudget(6, self.sellers[1], "stock s2", "Stock for s2")
+
+    def test_check(self):
+        serial = Sale.objects.all()[0].serial
+        self.assertBudget(5, self.sellers[1], "check %s" % serial, serial)
+
+    def test_check_many(self):
+        serials = list(Sale.objects.values_list("serial", flat=True)) + ["EC8000001", "EC8000002"]
+        replies = self.assertBudget(5, self.sellers[1], "check %s" % ", ".join(serials), "40 of 42 registered")
+        self.assertTrue(len(replies) <= 4, replies)
+        self.assertTrue(max(len(r) for r in replies) <= 160)
+        text = " ".join(replies)
+        for serial in serials:
+            self.assertTrue(serial in text, serial)
+        self.assertTrue("not recognized EC8000001 EC8000002" in text)
+
+    def test_new(self):
+        stock = self.stock(self.manager, self.ecozoom)
+        self.assertBudget(12, self.manager, "new 10ec 5ef", "added")
+        self.assertEqual(self.stock(self.manager, self.ecozoom), stock + 10)
+
+    def test_manager(self):
+        self.assertBudget(16, self.manager, "manager s2", "has been made a manager")
+
+    def test_register(self):
+        replies = self.assertMaxQueries(11, self.send, "0755999999", "register Jane Doe jdoe org")
+        self.assertTrue("Thank you for registering" in replies[0])
+
+    def test_language(self):
+        self.assertBudget(8, self.sellers[1], "language en", "I will speak to you in")
+
+
+class PageBudgetTest(QueryBudgetTestCase):
+
+    def get(self, url):
+        response = self.client.get(url)
+        #exports are written as they're read, so read them while counting
+        content = "".join(response)
+        self.assertEqual(response.status_code, 200)
+        return content
+
+    def test_dashboard(self):
+        self.client.login(username="manager", password="secret")
+        self.assertMaxQueries(11, self.get, "/")
+
+    def test_dashboard_cached(self):
+        self.client.login(username="manager", password="secret")
+        self.get("/")
+        self.assertMaxQueries(6, self.get, "/")
+
+    def test_admin_dashboard(self):
+        self.client.login(username="staff", password="secret")
+        self.assertMaxQueries(6, self.get, "/retail/admin_dashboard/")
+
+    def test_sales(self):
+        self.client.login(username="manager", password="secret")
+        self.assertMaxQueries(6, self.get, "/retail/sales/")
+
+    def test_sales_pages(self):
+        #sales of the same time are paged by serial
+        Sale.objects.filter(serial__lt="EC0000020").update(purchase_date=datetime(2012, 3, 1))
+        expected = list(Sale.objects.order_by("-purchase_date", "-serial").values_list("serial", flat=True))
+        factory = RequestFactory()
+        url, pages = "/retail/sales/", []
+        while url:
+            table = SaleTable(Sale.objects.all(), factory.get(url), per_page=7)
+            pages.append([row.obj.serial for row in table.rows])
+            url = table.next_url()
+        self.assertEqual(sum(pages, []), expected)
+        #and back from the last page
+        table = SaleTable(Sale.objects.all(), factory.get(table.previous_url()), per_page=7)
+        self.assertEqual([row.obj.serial for row in table.rows], pages[-2])
+
+    def grid_data(self, rows):
+        data = {"form-TOTAL_FORMS": "10", "form-INITIAL_FORMS": "0", "form-MAX_NUM_FORMS": ""}
+        for i, (serial, seller) in enumerate(rows):
+            for name, value in [("serial", serial), ("seller", seller.pk), ("fname", "Ann"), ("lname", "Bee"),
+                                ("pri_phone", "0712345678"), ("purchase_price", "25"), ("region", "A"),
+                                ("description", "Village"), ("purchase_date", "2012-03-01")]:
+                data["form-%d-%s" % (i, name)] = value
+        return data
+
+    def test_sales_grid(self):
+        self.client.login(username="manager", password="secret")
+        self.assertMaxQueries(6, self.get, "/retail/sales/grid/")
+        rows = [("EC9000001", self.sellers[1]), ("EC9000002", self.sellers[1]), ("EF9000001", self.sellers[2])]
+        response = self.assertMaxQueries(22, self.client.post, "/retail/sales/grid/", self.grid_data(rows))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Sale.objects.filter(serial__contains="9000").count(), 3)
+        self.assertEqual(self.sellers[1].sale_set.count(), 2 + SALES / SELLERS)
+
+    def test_sales_grid_errors(self):
+        self.client.login(username="manager", password="secret")
+        Stock.objects.filter(seller=self.sellers[2]).update(stock_amount=0)
+        rows = [("EC9000001", self.sellers[1]), ("EF0000001", self.sellers[1]), ("EF9000001", self.sellers[2])]
+        response = self.client.post("/retail/sales/grid/", self.grid_data(rows))
+        self.assertEqual(response.status_code, 200)
+        forms = response.context["formset"].forms
+        self.assertEqual(forms[1].errors["serial"], ["EF0000001 already registered"])
+        self.assertEqual(forms[2].errors["seller"], ["No EF in stock"])
+        self.assertFalse(Sale.objects.filter(serial__contains="9000").exists())
+
+    def test_sales_grid_partly_saved(self):
+        rows = [("EC9000001", self.sellers[1]), ("EC9000002", self.sellers[1]), ("EF9000001", self.sellers[2])]
+        formset = SaleGridFormSet(Contact.objects.filter(organization=self.org), data=self.grid_data(rows))
+        self.assertTrue(formset.is_valid())
+        #the rows saved before the others lost their stock aren't shown again
+        redisplayed = formset.without(formset.sales[:2])
+        self.assertEqual([f.data.get(f.add_prefix("serial")) for f in redisplayed.forms if f.has_changed()],
+                         ["EF9000001"])
+        self.assertEqual(len(redisplayed.forms), 10)
+
+    def test_csv_export(self):
+        self.client.login(username="manager", password="secret")
+        end = datetime.now().date()
+        start = end - timedelta(days=settings.RETAIL_SYNC_EXPORT_DAYS - 1)
+        content = self.assertMaxQueries(6, self.get, "/retail/sales/export/%d/?start=%s&end=%s" % (
+            self.org.id, start, end))
+        sales = Sale.objects.filter(seller__organization=self.org, purchase_date__gte=start)
+        self.assertEqual(len(content.splitlines()), 1 + sales.count())
+
+    def test_csv_export_queued(self):
+        self.client.login(username="manager", password="secret")
+        #the whole history, or too long a range, isn't exported in the request
+        response = self.client.get("/retail/sales/export/%d/" % self.org.id)
+        self.assertRedirects(response, "/retail/advanced/")
+        end = datetime.now().date()
+        self.client.get("/retail/sales/export/%d/?start=%s&end=%s" % (
+            self.org.id, end - timedelta(days=settings.RETAIL_SYNC_EXPORT_DAYS), end))
+        self.assertEqual(ExportJob.objects.filter(organization=self.org, status=ExportJob.PENDING).count(), 2)
+        #as the Export CSV buttons do, which reuses the queued job
+        response = self.client.post("/retail/advanced/", {"organization": self.org.id, "submit": "Export CSV"})
+        self.assertRedirects(response, "/retail/advanced/")
+        self.assertEqual(ExportJob.objects.count(), 2)
+
+    def test_csv_export_chunks(self):
+        #sales of the same time are split across chunks by serial
+        Sale.objects.filter(serial__lt="EC0000020").update(purchase_date=datetime(2012, 3, 1))
+        expected = list(Sale.objects.order_by("purchase_date", "serial").values_list("serial", flat=True))
+        self.assertEqual([row[2] for row in export.sale_rows(Sale.objects.all(), chunk_size=7)], expected)
+
+    def test_stale_export(self):
+        job = ExportJob.request(self.org)
+        self.assertTrue(job.claim())
+        #its worker died an hour ago
+        ExportJob.objects.filter(id=job.id).update(date_started=datetime.now() - timedelta(seconds=ExportJob.STALE_AFTER + 1))
+        again = ExportJob.request(self.org)
+        self.assertEqual(again.id, job.id)
+        self.assertEqual(again.status, ExportJob.PENDING)
+
+    def test_sales_feed(self):
+        self.client.login(username="manager", password="secret")
+        #changes aren't passed by the cursor until they're FEED_LAG old
+        SaleChange.objects.update(date=datetime.now() - timedelta(seconds=SaleChange.FEED_LAG + 1))
+        settled = SaleChange.settled_id()
+        self.send(self.identities[self.sellers[1].pk], "sale EC9000001 john smith 0712345678 25 A village")
+        response = self.client.get("/retail/sales/export/changes/%d/?since=%d" % (self.org.id, settled - 1))
+        self.assertEqual(response["X-Export-Cursor"], str(settled))
+        #the new sale is sent now, and again after the next cursor
+        self.assertTrue("EC9000001" in "".join(response).splitlines()[-1])
+
+    def test_registration(self):
+        self.client.login(username="manager", password="secret")
+        self.assertMaxQueries(18, self.get, "/registration/")
+
+class SaleTest(QueryBudgetTestCase):
+    """
+    How sales keep stock, revenue and the rollups in step outside the
+    SMS commands.
+    """
+
+    def test_edit(self):
+        sale = Sale.objects.filter(seller=self.sellers[1])[0]
+        stock = self.stock(self.sellers[1], sale.product)
+        sale.fname = "Carol"
+        sale.save()
+        self.assertEqual(Sale.objects.get(serial=sale.serial).fname, "Carol")
+        self.assertEqual(self.stock(self.sellers[1], sale.product), stock)
+
+
+    def rollup_totals(self):
+        return SaleRollup.objects.aggregate(Sum("sale_count"), Sum("revenue"))
+
+    def test_delete(self):
+        #as from the admin, rather than with the cancel command
+        Sale.objects.get(serial="EF0000001").delete()
+        self.assertEqual(self.rollup_totals(), {"sale_count__sum": SALES - 1, "revenue__sum": (SALES - 1) * 10000})
+
+    def test_delete_invalidates_after_commit(self):
+        versions = []
+        def deleted(sender, instance, **kwargs):
+            versions.append(caching.get_version(self.org.id))
+        version = caching.get_version(self.org.id)
+        post_delete.connect(deleted, sender=Sale)
+        try:
+            Sale.objects.get(serial="EF0000001").delete()
+        finally:
+            post_delete.disconnect(deleted, sender=Sale)
+        #not while the delete could still be rolled back
+        self.assertEqual(versions, [version])
+        self.assertNotEqual(caching.get_version(self.org.id), version)
+
+    def test_rebuild_rollups(self):
+        totals = self.rollup_totals()
+        SaleRollup.objects.update(sale_count=0)
+        call_command("rebuild_rollups", chunk_size=7, verbosity=0)
+        self.assertEqual(self.rollup_totals(), totals)
+
+    def test_save_many_in_callers_transaction(self):
+        #tests run in a transaction of their own, and sqlite has no
+        #savepoints, so a sale lost since the check can't be retried
+        Stock.objects.filter(seller=self.sellers[1]).update(stock_amount=0)
+        sale = Sale(serial="EC9000001", product=self.ecozoom, seller=self.sellers[1], purchase_date=datetime.now(),
+                    purchase_price=Decimal("25"), fname="Ann", lname="Bee", pri_phone="0712345678", region="A",
+                    description="Village")
+        check_many = Sale.__dict__['check_many']
+        Sale.check_many = classmethod(lambda cls, sales: (sales, []))
+        try:
+            self.assertRaises(OutOfStock, Sale.save_many, [sale])
+        finally:
+            Sale.check_many = check_many
+
+    def test_last_sale_after_cancel(self):
+        #the seller's latest sale was a day ago, and the one before six
+        self.send(self.identities[self.sellers[1].pk], "cancel EF0000001")
+        seller = with_performance(Contact.objects.filter(pk=self.sellers[1].pk))[0]
+        self.assertEqual(str(seller.last_sale)[:10], str((datetime.now() - timedelta(days=6)).date()))
+
+    def test_product_from_another_process(self):
+        Product.catalog()
+        #changed without the signal that reloads this process's catalog
+        Product.objects.filter(pk=self.ecozoom.pk).update(code="EZ")
+        self.assertEqual(Product.by_code("EZ").pk, self.ecozoom.pk)
+
+    def test_settle_contended(self):
+        stock = self.stock(self.sellers[1], self.ecozoom)
+        self.send(self.identities[self.manager.pk], "restock s1 5ec")
+        pending = StockTransaction.objects.filter(recipient=self.sellers[1].pk)
+
+        class Racing(object):
+            #reads the pending transactions, then lets another process
+            #accept them before they're claimed
+            def filter(self, **kwargs):
+                return self
+            def select_related(self, *fields):
+                return self
+            def __iter__(self):
+                read = list(pending.filter(status=StockTransaction.PENDING))
+                pending.update(status=StockTransaction.ACCEPTED)
+                return iter(read)
+
+        self.assertEqual(StockTransaction.settle(Racing(), StockTransaction.ACCEPTED), [])
+        self.assertEqual(self.stock(self.sellers[1], self.ecozoom), stock)
+
+
+class TimingTest(QueryBudgetTestCase):
+
+    def setUp(self):
+        super(TimingTest, self).setUp()
+        #drop whatever earlier tests left to be flushed
+        timing.flush()
+        HandlerTiming.objects.all().delete()
+        self.flush_interval = timing.FLUSH_INTERVAL
+
+    def tearDown(self):
+        timing.FLUSH_INTERVAL = self.flush_interval
+        super(TimingTest, self).tearDown()
+
+    def test_flushed_when_due(self):
+        self.send(self.identities[self.sellers[1].pk], "stock")
+        self.assertFalse(HandlerTiming.objects.exists())
+        timing.FLUSH_INTERVAL = 0
+        self.send(self.identities[self.sellers[1].pk], "st")
+        self.send(self.identities[self.manager.pk], "restock s1 5ec")
+        stock = HandlerTiming.objects.get(keyword="stock")
+        self.assertEqual(stock.messages, 2)
+        self.assertEqual(sum(getattr(stock, f) for f in HandlerTiming.bucket_fields()), 2)
+        self.assertTrue(stock.queries >= 2)
+        self.assertEqual(HandlerTiming.objects.get(keyword="restock").messages, 1)
+
+    def test_advanced(self):
+        timing.FLUSH_INTERVAL = 0
+        self.send(self.identities[self.sellers[1].pk], "check %s" % Sale.objects.all()[0].serial)
+        self.client.login(username="manager", password="secret")
+        response = self.client.get("/retail/advanced/")
+        self.assertEqual([t["keyword"] for t in response.context["handler_timings"]], ["check"])
+
+
+class ImportTest(QueryBudgetTestCase):
+
+    def setUp(self):
+        super(ImportTest, self).setUp()
+        self.import_dir = settings.RETAIL_IMPORT_DIR
+        settings.RETAIL_IMPORT_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(settings.RETAIL_IMPORT_DIR)
+        settings.RETAIL_IMPORT_DIR = self.import_dir
+        super(ImportTest, self).tearDown()
+
+    def upload(self, rows):
+        lines = ["Retailer alias,Serial #,Sale date,First name,Last name,Primary phone,Price,Region,Location notes"]
+        lines.extend(",".join(row) for row in rows)
+        self.client.login(username="manager", password="secret")
+        f = SimpleUploadedFile("sales.csv", "\r\n".join(lines))
+        response = self.client.post("/retail/sales/import/", {"file": f})
+        self.assertEqual(response.status_code, 302)
+        return ImportJob.objects.get()
+
+    def test_import(self):
+        stock = Stock.objects.get(seller=self.sellers[1], product=self.ecozoom).stock_amount
+        sale = ["2012-03-01", "Ann", "Bee", "0712345678", "25", "Arusha", "Village"]
+        job = self.upload([["s1", "EC9000001"] + sale, ["S2", "ec9000002"] + sale, ["s3", "EF9000001"] + sale,
+                           ["s1", "EF0000001"] + sale, ["s4", "EC9000003"] + sale, ["s9", "EC9000004"] + sale,
+                           ["s1", "EC9000005", "1/3/2012", "Ann", "Bee", "0712345678", "99", "Nowhere", "Village"]])
+        self.assertTrue(job.claim())
+        #one chunk costs the same whatever its size
+        self.assertMaxQueries(26, job.run)
+        job = ImportJob.objects.get()
+        self.assertEqual(job.status, ImportJob.DONE)
+        self.assertEqual((job.rows_read, job.rows_imported, job.rows_rejected), (7, 3, 4))
+        self.assertEqual(Sale.objects.filter(serial__contains="9000").count(), 3)
+        self.assertEqual(Stock.objects.get(seller=self.sellers[1], product=self.ecozoom).stock_amount, stock - 1)
+
+        response = self.client.get("/retail/sales/import/%d/rejected/" % job.id)
+        rejected = list(csv.reader("".join(response).splitlines()))
+        self.assertEqual(rejected[0][-1], "Error")
+        self.assertEqual(sorted((row[1], row[-1]) for row in rejected[1:]),
+                         [("EC9000003", "retailer s4 not found"), ("EC9000004", "retailer s9 not found"),
+                          ("EC9000005", "price is too high, region NOWHERE not found"),
+                          ("EF0000001", "already registered")])
+
+    def test_stale_import(self):
+        job = self.upload([])
+        self.assertTrue(job.claim())
+        ImportJob.objects.update(date_started=datetime.now() - timedelta(seconds=ImportJob.STALE_AFTER + 1))
+        call_command("run_imports", once=True, keep_days=0, verbosity=0)
+        #failed, then purged with its file
+        self.assertFalse(ImportJob.objects.exists())
+        self.assertFalse(os.path.exists(job.path))
+
+    def test_missing_column(self):
+        self.client.login(username="manager", password="secret")
+        f = SimpleUploadedFile("sales.csv", "Serial #,Price\r\nEC9000001,25\r\n")
+        self.client.post("/retail/sales/import/", {"file": f})
+        job = ImportJob.objects.get()
+        job.run()
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertTrue(job.error.startswith("The file has no Sale date, Retailer alias"))
+
+
+class GrammarTest(TestCase):
+
+    def setUp(self):
+        Product.reset_catalog()
+        Product.objects.create(code="EC", display_name="Ecozoom", full_name="Ecozoom stove")
 
-__test__ = {"doctest": """
-Another way to test that 1 + 1 is equal to 2.
+    def test_keywords(self):
+        for text, name in [("s EC1", "sale"), ("st", "stock"), ("STK s1", "stock"), ("c EC1", "check"),
+                           ("cancel EC1", "cancel"), ("n 100ec", "new"), ("n", "no"), ("no", "no"), ("Y", "yes"),
+                           ("restock, s1 5ec", "restock"), ("lang en", "language")]:
+            self.assertEqual(grammar.parse(text).name, name, text)
+        for text in ["yesterday", "nothing", " hello there", "", "sell EC1"]:
+            self.assertEqual(grammar.parse(text), None, text)
+        self.assertEqual(grammar.parse("rs  s1 5ec 3ef ").text, "s1 5ec 3ef")
 
->>> 1 + 1 == 2
-True
-"""}
+    def test_sale_fields(self):
+        command = grammar.parse("sale ec1234567 john SMITH 0712345678 25 a upper village")
+        self.assertEqual(command.errors, [])
+        self.assertEqual(command.fields, {"serial": "EC1234567", "fname": "John", "lname": "Smith",
+                                          "pri_phone": "0712345678", "purchase_price": Decimal("25"),
+                                          "region": "A", "description": "Upper Village"})
 
+    def test_sale_errors(self):
+        self.assertEqual(grammar.parse("sale EC1234567 john").errors,
+                         ["missing lastname, mobile#, price, regioncode, village"])
+        self.assertEqual(grammar.parse("sale XY1234567 j0hn smith 0712 cheap ? village").errors,
+                         ["product XY not found", "cust name j0hn not understood", "phone # is mising digits",
+                          "price cheap is not a number", "region ? not found"])
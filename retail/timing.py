@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Timing of the SMS handlers. Each handler class is wrapped with ``timed``,
+which measures how long handling a message took, and how many queries it
+ran in how long, without needing DEBUG. The figures are added up per
+keyword in memory, and written to HandlerTiming every FLUSH_INTERVAL
+seconds, so timing a message costs no queries of its own.
+"""
+
+import re
+import time
+import threading
+from datetime import datetime
+from django.conf import settings
+from django.db import connection, transaction
+
+FLUSH_INTERVAL = getattr(settings, "RETAIL_TIMING_FLUSH_INTERVAL", 60)
+
+_lock = threading.Lock()
+_pending = {}
+_flushed_at = time.time()
+
+def keyword_of(handler):
+    """
+    The name a handler's figures are kept under: its command, the first
+    of its keywords, or its class name.
+    """
+    if getattr(handler, "command", None):
+        return handler.command
+    name = getattr(handler, "keyword", None) or getattr(handler, "pattern", None)
+    if not name:
+        return handler.__name__.replace("Handler", "").lower()
+    return re.sub(r"^\(\?\w+\)", "", name).split("|")[0]
+
+def record(keyword, elapsed_ms, queries, db_ms):
+    """
+    Count a message handled under ``keyword``, flushing the counts
+    collected so far if they're due.
+    """
+    from retail.models import HandlerTiming
+    global _flushed_at
+    bucket = len(HandlerTiming.BUCKETS)
+    for i, bound in enumerate(HandlerTiming.BUCKETS):
+        if elapsed_ms <= bound:
+            bucket = i
+            break
+    _lock.acquire()
+    try:
+        totals = _pending.setdefault(keyword, [0, 0.0, 0.0, 0, [0] * (len(HandlerTiming.BUCKETS) + 1)])
+        totals[0] += 1
+        totals[1] += elapsed_ms
+        totals[2] += db_ms
+        totals[3] += queries
+        totals[4][bucket] += 1
+        due = time.time() - _flushed_at >= FLUSH_INTERVAL
+    finally:
+        _lock.release()
+    if due:
+        flush()
+
+@transaction.commit_on_success
+def flush():
+    """
+    Add the counts collected since the last flush to HandlerTiming.
+    """
+    from retail.models import HandlerTiming
+    global _pending, _flushed_at
+    _lock.acquire()
+    try:
+        pending, _pending = _pending, {}
+        _flushed_at = time.time()
+    finally:
+        _lock.release()
+    hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+    for keyword, (messages, total_ms, db_ms, queries, buckets) in pending.items():
+        totals = dict(zip(HandlerTiming.bucket_fields(), buckets))
+        totals.update(messages=messages, total_ms=int(total_ms), db_ms=int(db_ms), queries=queries)
+        HandlerTiming.record(keyword, hour, totals)
+
+def timed(handler):
+    """
+    Class decorator timing each message ``handler`` accepts.
+    """
+    dispatch = handler.dispatch.im_func
+    keyword = keyword_of(handler)
+
+    def timed_dispatch(cls, router, msg):
+        #the debug cursor is the cheapest way to see the queries run. Drop
+        #what it logged afterwards, unless it was being logged anyway
+        use_debug_cursor = connection.use_debug_cursor
+        keep = use_debug_cursor or (use_debug_cursor is None and settings.DEBUG)
+        connection.use_debug_cursor = True
+        logged = len(connection.queries)
+        started = time.time()
+        try:
+            handled = dispatch(cls, router, msg)
+        finally:
+            elapsed = time.time() - started
+            connection.use_debug_cursor = use_debug_cursor
+            queries = connection.queries[logged:]
+            if not keep:
+                del connection.queries[logged:]
+        if handled:
+            db_time = sum(float(q["time"]) for q in queries)
+            record(keyword, elapsed * 1000, len(queries), db_time * 1000)
+        return handled
+
+    handler.dispatch = classmethod(timed_dispatch)
+    return handler
@@ -9,10 +9,20 @@ urlpatterns = patterns('',
     url(r'^admin_dashboard/$', views.admin_dashboard, name='admin-dashboard'),
     url(r'^advanced/$', 'retail.views.advanced', name='advanced'),
     url(r'^sales/$', 'retail.views.sales', name='sales'),
+    url(r'^sales/grid/$', 'retail.views.sales_grid', name='sales-grid'),
     url(r'^sales/export/$', views.csv_export,
         name='export'),
     url(r'^sales/export/(?P<org_id>\d+)/$', views.csv_export,
         name='export'),
+    url(r'^sales/export/changes/$', views.sales_feed,
+        name='export-changes'),
+    url(r'^sales/export/changes/(?P<org_id>\d+)/$', views.sales_feed,
+        name='export-changes'),
+    url(r'^sales/export/jobs/(?P<job_id>\d+)/$', views.export_download,
+        name='export-download'),
+    url(r'^sales/import/$', 'retail.views.sales_import', name='sales-import'),
+    url(r'^sales/import/(?P<job_id>\d+)/rejected/$', views.import_rejected,
+        name='import-rejected'),
 #(r'^retail_media/(?P<path>.*)$', 'django.views.static.serve',
 #        {'document_root': '/retail/static'}),
 )
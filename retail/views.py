@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 
-import csv
+import os
 
+from django.conf import settings
 from django.template import RequestContext
 from django.core.urlresolvers import reverse#
 from django.http import HttpResponseRedirect#
-from django.http import HttpResponse
-from django.shortcuts import render_to_response
+from django.http import HttpResponse, Http404
+from django.shortcuts import render_to_response, get_object_or_404
+from django.core.servers.basehttp import FileWrapper
 
-from django.db.models import Sum
+from django.db import IntegrityError
+from django.db.models import Sum, Count
+from django.forms.util import ErrorList
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.decorators import user_passes_test
@@ -17,40 +21,78 @@ from django.contrib.admin.models import User
 
 from rapidsms.models import Contact
 
-from pikwa.forms import SaleForm
-from pikwa.tables import SaleTable, PerformanceTable
+from pikwa.forms import SaleForm, SaleGridFormSet, ExportJobForm, ImportJobForm
+from pikwa.tables import SaleTable, PerformanceTable, with_performance
 
-from retail.models import Sale, Stock, Product, Organization
+from retail.models import Sale, SaleRollup, SaleChange, Stock, Product, Organization, ExportJob, ImportJob, OutOfStock, HandlerTiming
+from retail import caching, export
 
 from datetime import datetime, timedelta, time
 
 def get_inventory_list(org):
+    """
+    Sale count and stock on hand for each product stocked by ``org``,
+    using one grouped query for the stock and one over the sale rollups.
+    """
+    sale_counts = dict(SaleRollup.objects.filter(organization=org)
+        .values_list('product').annotate(Sum('sale_count')).order_by())
+    products = Product.objects.filter(stock__seller__organization=org)\
+        .annotate(stock_count=Sum('stock__stock_amount')).order_by('id')
     inventory_list = []
-    for p in Product.objects.all():
-        sale_count = Sale.objects.filter(seller__organization=org, product=p).count()
-        stocks = Stock.objects.filter(seller__organization=org, product=p)
-        if stocks:
-            stock_count = stocks.aggregate(Sum('stock_amount'))
-            inventory_list.append({'product': p, 'sale_count': sale_count, 'stock_count': stock_count['stock_amount__sum']})
+    for p in products:
+        inventory_list.append({'product': p, 'sale_count': sale_counts.get(p.id, 0), 'stock_count': p.stock_count})
     return inventory_list
 
-def get_sale_bars(org):
-    sale_bars = []
-    sales = Sale.objects.all()
+#default bucket size for each selectable sales chart window, in days
+SALE_BAR_WINDOWS = {30: 'day', 90: 'week', 365: 'month'}
+SALE_BAR_BUCKETS = ('day', 'week', 'month')
+
+def _bucket_start(d, bucket):
+    if bucket == 'week':
+        return d - timedelta(days=d.weekday())
+    if bucket == 'month':
+        return d.replace(day=1)
+    return d
+
+def get_sale_bars(org, days=30, bucket='day'):
+    """
+    Sale counts for the last ``days`` days, grouped into day, week or
+    month buckets. The counts per day come back from a single grouped
+    query over the sale rollups, and are folded into larger buckets here.
+    """
+    today = datetime.now().date()
+    first_day = today - timedelta(days=days - 1)
+    rollups = SaleRollup.objects.filter(day__gte=first_day)
     if org != "ALL":
-        sales = Sale.objects.filter(seller__organization=org)
-    for i in range(0,30):
-        d = datetime.now().date() - timedelta(days=i)
-        day_start = datetime.combine(d, time.min)
-        day_end = datetime.combine(d, time.max)
-        sale_count = sales.filter(purchase_date__range=(day_start, day_end)).count()
-        if i % 3 == 0:
-            label = d.strftime("%d-%b")
-        else:
-            label = ""
-        sale_bars.insert(0,{'date': d, 'sale_count': sale_count, 'label': label})
+        rollups = rollups.filter(organization=org)
+    counts = dict(rollups.values_list('day').annotate(Sum('sale_count')).order_by())
+
+    sale_bars = []
+    for i in range(0, days):
+        d = first_day + timedelta(days=i)
+        start = _bucket_start(d, bucket)
+        if not sale_bars or sale_bars[-1]['date'] != start:
+            sale_bars.append({'date': start, 'sale_count': 0, 'label': ""})
+        sale_bars[-1]['sale_count'] += counts.get(d, 0)
+
+    #label roughly ten bars, counting back from the most recent one
+    step = max(1, len(sale_bars) // 10)
+    label_format = bucket == 'month' and "%b-%y" or "%d-%b"
+    for i, bar in enumerate(reversed(sale_bars)):
+        if i % step == 0:
+            bar['label'] = bar['date'].strftime(label_format)
     return sale_bars
 
+def get_dashboard_figures(org, window=30, bucket='day'):
+    totals = SaleRollup.objects.filter(organization=org).aggregate(Sum('sale_count'), Sum('revenue'))
+    return {
+        'staff_count': Contact.objects.filter(organization=org).count(),
+        'sale_count': totals['sale_count__sum'] or 0,
+        'total_revenue': totals['revenue__sum'] or 0,
+        'inventory_list': get_inventory_list(org),
+        'sale_bars': get_sale_bars(org, window, bucket),
+    }
+
 @login_required
 #TODO take the user somewhere informative if they don't pass the test
 @user_passes_test((lambda u: u.get_profile().organization is not None) or (lambda u: u.is_staff))
@@ -68,70 +110,78 @@ def dashboard(request, org_id=None, template_name="retail/dashboard.html"):
     else:
         return HttpResponse(status=550)
     
-    staff_count = Contact.objects.filter(organization=org).count()
-    all_sales = Sale.objects.filter(seller__organization=org)
-    sale_count = all_sales.count()
-    total_revenue = all_sales.aggregate(Sum('purchase_price'))
-    inventory_list = get_inventory_list(org)
+    try:
+        window = int(request.GET.get('window', 30))
+    except ValueError:
+        window = 30
+    if window not in SALE_BAR_WINDOWS:
+        window = 30
+    bucket = request.GET.get('bucket', SALE_BAR_WINDOWS[window])
+    if bucket not in SALE_BAR_BUCKETS:
+        bucket = SALE_BAR_WINDOWS[window]
 
+    #the sale bars end today, so the figures are kept by day as well as
+    #until the organization's next sale
+    context.update(caching.get_or_build(org.id, "dashboard:%s:%s:%s" % (datetime.now().date(), window, bucket),
+        lambda: get_dashboard_figures(org, window, bucket)))
     context['organization'] = org
-    context['staff_count'] = staff_count
-    context['sale_count'] = sale_count
-    try:
-        context['total_revenue'] = int(total_revenue['purchase_price__sum']*1000)
-    except:
-        context['total_revenue'] = 0
-    context['inventory_list'] = inventory_list
-    #TODO make top_sellers include only a fixed number of sellers, or paginate
-    top_sellers = Contact.objects.filter(organization=org)
+    #the table pages through the sellers, RETAIL_TOP_SELLERS at a time
+    top_sellers = with_performance(Contact.objects.filter(organization=org))
     context['performance_table'] = PerformanceTable(top_sellers, request)
-    context['sale_bars'] = get_sale_bars(org)
+    context['sale_bar_window'] = window
+    context['sale_bar_bucket'] = bucket
+    context['sale_bar_windows'] = sorted(SALE_BAR_WINDOWS.keys())
+    context['sale_bar_buckets'] = SALE_BAR_BUCKETS
 
     return  render_to_response(template_name, {},
  context_instance=RequestContext(request, context))
 
-@user_passes_test(lambda u: u.is_staff)
-def admin_dashboard(request, template_name="retail/admin_dashboard.html"):
-    context = {}
-    
-    organization_count = Organization.objects.count()
+def get_admin_dashboard_figures():
     total_staff_count = Contact.objects.count()
-    total_sale_count = Sale.objects.count()
-    total_revenue = Sale.objects.aggregate(Sum('purchase_price'))
 
-    #generate data for heat map
+    #generate data for heat map from the rollup totals per region. every
+    #sale has a region, so these also add up to the overall totals
+    region_totals = SaleRollup.objects.values_list('region').annotate(Sum('sale_count'), Sum('revenue')).order_by()
+    region_counts = dict((region, count) for region, count, revenue in region_totals)
+    total_sale_count = sum(region_counts.values())
+    total_revenue = sum(revenue for region, count, revenue in region_totals)
     map_data=[]
     for n in range(1,27):
         #get the capital letter region code per Sale.REGION_CHOICES
         p = chr(n+64)
-        sls = Sale.objects.filter(region=p)
         n_padded = '%02d' % n
-        percent_sales = int(round(float(sls.count()) / total_sale_count * 100,0))
+        if total_sale_count:
+            percent_sales = int(round(float(region_counts.get(p, 0)) / total_sale_count * 100,0))
+        else:
+            percent_sales = 0
         if percent_sales > 0:
             percent_sales += 10 #offset for visibility
         region_data = {'number': n_padded, 'sale_percent': percent_sales}
         map_data.append(region_data)
 
-    #per organization stats table
+    #per organization stats table. staff and revenue are grouped over the
+    #organization's contacts (whose reverse relation is named after the
+    #MobileUser extension), and sale counts come from the rollups
+    org_sale_counts = dict(SaleRollup.objects.values_list('organization').annotate(Sum('sale_count')).order_by())
+    organizations = Organization.objects.annotate(staff_count=Count('mobileuser'), revenue=Sum('mobileuser__cached_revenue')).order_by('id')
     org_table=[]
-    for o in Organization.objects.all():
-        sales = Sale.objects.filter(seller__organization=o)
-        sale_count = sales.count()
+    for o in organizations:
+        sale_count = org_sale_counts.get(o.id, 0)
         if sale_count > 0:
-            sellers = Contact.objects.filter(organization=o)
-            staff_count = sellers.count()
-            revenue = sellers.aggregate(Sum('cached_revenue'))['cached_revenue__sum']
-            org_data = {'name': o.display_name, 'id': o.id, 'sale_count': sale_count, 'staff_count': staff_count, 'revenue': revenue}
+            org_data = {'name': o.display_name, 'id': o.id, 'sale_count': sale_count, 'staff_count': o.staff_count, 'revenue': o.revenue}
             org_table.append(org_data)
 
-    context['total_staff_count'] = total_staff_count
-    context['total_sale_count'] = total_sale_count
-    try:
-        context['total_revenue'] = int(total_revenue['purchase_price__sum']*1000)
-    except:
-        context['total_revenue'] = 0
-    context['map_data'] = map_data
-    context['org_table'] = org_table
+    return {
+        'total_staff_count': total_staff_count,
+        'total_sale_count': total_sale_count,
+        'total_revenue': total_revenue,
+        'map_data': map_data,
+        'org_table': org_table,
+    }
+
+@user_passes_test(lambda u: u.is_staff)
+def admin_dashboard(request, template_name="retail/admin_dashboard.html"):
+    context = caching.get_or_build(caching.ALL, "admin_dashboard", get_admin_dashboard_figures)
 
     return  render_to_response(template_name, {},
  context_instance=RequestContext(request, context))
@@ -162,8 +212,14 @@ def sales(request, template_name="retail/sales.html"):
             #so this is probably a safe way to do it
             sale = sale_form.save(commit=False)
             sale.product = Product.by_code(sale.serial[0:2].upper())
-            sale.save() 
-            return HttpResponseRedirect(reverse(sales))
+            try:
+                sale.save()
+            except OutOfStock:
+                sale_form._errors['seller'] = sale_form.error_class(["%s has no %s in stock" % (sale.seller.alias, sale.product.display_name)])
+            except IntegrityError:
+                sale_form._errors['serial'] = sale_form.error_class(["Serial %s already registered" % sale.serial])
+            else:
+                return HttpResponseRedirect(reverse(sales))
 
     if org:
         stb = SaleTable(Sale.objects.filter(seller__organization=request.user.get_profile().organization), request) 
@@ -179,29 +235,201 @@ def sales(request, template_name="retail/sales.html"):
     )
 
 @login_required
-def csv_export(request, org_id=None):
-    response = HttpResponse(mimetype='text/csv')
-    response['Content-Disposition'] = 'attachment; filename=sales_export.csv'
+@user_passes_test(lambda u: u.get_profile().organization is not None)
+def sales_grid(request, template_name="retail/sales_grid.html"):
+    """
+    A page of sales typed in at once, e.g. from a receipt book, which are
+    all checked and then saved together.
+    """
+    org = request.user.get_profile().organization
+    sellers = Contact.objects.filter(organization=org).order_by('alias')
+    if request.method == "POST":
+        formset = SaleGridFormSet(sellers, data=request.POST)
+        if formset.is_valid():
+            saved, rejected = Sale.save_many(formset.sales)
+            if not rejected:
+                return HttpResponseRedirect(reverse(sales))
+            #stock or serials were taken by someone else in the meantime.
+            #Only the rows that weren't saved are shown again
+            formset = formset.without(saved)
+            formset.is_valid()
+            formset._non_form_errors = ErrorList(["%d sales saved, these weren't: %s" % (
+                len(saved), "; ".join("%s %s" % (s.serial, reason) for s, reason in rejected))])
+    else:
+        formset = SaleGridFormSet(sellers)
+
+    return render_to_response(template_name, {
+            "formset": formset,
+        }, context_instance=RequestContext(request))
+
+@login_required
+@user_passes_test(lambda u: u.get_profile().organization is not None)
+def sales_import(request, template_name="retail/sales_import.html"):
+    """
+    Upload a CSV file of sales, to be imported in the background by the
+    run_imports command, and the progress of earlier uploads.
+    """
+    org = request.user.get_profile().organization
+    if request.method == "POST":
+        import_form = ImportJobForm(request.POST, request.FILES)
+        if import_form.is_valid():
+            ImportJob.upload(request.FILES['file'], org, request.user)
+            return HttpResponseRedirect(reverse(sales_import))
+    else:
+        import_form = ImportJobForm()
+
+    return render_to_response(template_name, {
+            "import_form": import_form,
+            "import_jobs": ImportJob.objects.filter(organization=org).order_by('-date_requested')[:20],
+        }, context_instance=RequestContext(request))
+
+@login_required
+def import_rejected(request, job_id):
+    job = get_object_or_404(ImportJob, id=job_id)
+    if not request.user.is_staff and job.organization != request.user.get_profile().organization:
+        return HttpResponse(status=550)
+    try:
+        f = open(job.rejected_path, "rb")
+    except IOError:
+        raise Http404
+    response = HttpResponse(FileWrapper(f), mimetype='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=%s' % job.rejected_file_name
+    response['Content-Length'] = os.path.getsize(job.rejected_path)
+    return response
+
+def get_export_org(request, org_id):
+    """
+    The organization whose sales ``request`` may export, None for every
+    organization (staff only), or False if it isn't allowed.
+    """
     try:
         org = Organization.objects.get(id=org_id)
     except:
         org = None
     if org is None and request.user.is_staff:
-        sale_list = Sale.objects.all().order_by('purchase_date')
+        return None
     elif org == request.user.get_profile().organization or request.user.is_staff:
-        sale_list = Sale.objects.filter(seller__organization = org).order_by('purchase_date')
+        return org
+    return False
+
+def _export_day(request, name):
+    value = request.GET.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise Http404
+
+@login_required
+def csv_export(request, org_id=None):
+    """
+    The sales from ``?start`` to ``?end`` (YYYY-MM-DD, inclusive), as
+    CSV. Only ranges of up to RETAIL_SYNC_EXPORT_DAYS are written in the
+    response; anything longer, or without both dates, is requested as an
+    export job, and the user sent to the list of jobs.
+    """
+    org = get_export_org(request, org_id)
+    if org is None:
+        sale_list = Sale.objects.all()
+    elif org:
+        sale_list = Sale.objects.filter(seller__organization = org)
+    else:
+        return HttpResponse(status=550)
+
+    start, end = _export_day(request, 'start'), _export_day(request, 'end')
+    max_days = getattr(settings, 'RETAIL_SYNC_EXPORT_DAYS', 31)
+    if start is None or end is None or (end - start).days >= max_days:
+        ExportJob.request(org, start, end, bool(request.GET.get('gzip')), request.user)
+        return HttpResponseRedirect(reverse('advanced'))
+    sale_list = sale_list.filter(purchase_date__gte=start, purchase_date__lt=end + timedelta(days=1))
+
+    #the response is written as the rows are read, rather than built up
+    #in memory first
+    lines = export.csv_lines(export.sale_rows(sale_list))
+    if request.GET.get('gzip'):
+        response = HttpResponse(export.gzip_chunks(lines), mimetype='application/x-gzip')
+        response['Content-Disposition'] = 'attachment; filename=sales_export.csv.gz'
     else:
+        response = HttpResponse(lines, mimetype='text/csv')
+        response['Content-Disposition'] = 'attachment; filename=sales_export.csv'
+    return response
+
+@login_required
+def sales_feed(request, org_id=None):
+    """
+    Sales recorded or canceled since the cursor passed as ``?since``, as
+    CSV, with cancellations as tombstone rows. Without a cursor every
+    current sale is sent. The cursor for the next request is returned in
+    the X-Export-Cursor header. It stays SaleChange.FEED_LAG seconds
+    behind the newest changes, which are sent again by the next request,
+    so rows must be applied by serial.
+    """
+    org = get_export_org(request, org_id)
+    if org is False:
         return HttpResponse(status=550)
+    cursor = SaleChange.settled_id()
+    since = request.GET.get('since')
+    if since:
+        try:
+            since = int(since)
+        except ValueError:
+            raise Http404
+        cursor = max(cursor, since)
+        changes = SaleChange.objects.filter(id__gt=since)
+        if org is not None:
+            changes = changes.filter(organization=org)
+        rows = export.change_rows(changes)
+    else:
+        sales = Sale.objects.all()
+        if org is not None:
+            sales = sales.filter(seller__organization=org)
+        rows = export.snapshot_rows(sales)
 
-    writer = csv.writer(response)
-    writer.writerow(['Sale date', 'Retailer', 'Serial #', 'Last name', 'First name', 'Primary phone', 'Secondary phone', 'Region', 'Location notes'])
-    for s in sale_list:
-        writer.writerow([s.purchase_date.date().strftime("%Y-%m-%d"), s.seller, s.serial, s.lname.capitalize(), s.fname.capitalize(), s.pri_phone, s.sec_phone,  s.get_region_display(), s.description])
+    response = HttpResponse(export.csv_lines(rows, export.CHANGE_HEADER), mimetype='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=sales_changes_%s.csv' % cursor
+    response['X-Export-Cursor'] = str(cursor)
     return response
 
 @login_required
 @user_passes_test(lambda u: u.get_profile().organization is not None)
 def advanced(request):
-    return render_to_response("retail/advanced.html", {}, context_instance=RequestContext(request))
+    org = request.user.get_profile().organization
+    jobs = ExportJob.objects.select_related('organization').order_by('-date_requested')
+    if not request.user.is_staff:
+        jobs = jobs.filter(organization=org)
 
+    if request.method == "POST":
+        export_form = ExportJobForm(data=request.POST)
+    else:
+        export_form = ExportJobForm(initial={'organization': org.id})
+    #only staff can export other organizations, or all of them at once
+    if not request.user.is_staff:
+        del export_form.fields['organization']
+
+    if request.method == "POST" and export_form.is_valid():
+        data = export_form.cleaned_data
+        ExportJob.request(data.get('organization', org), data['start_date'], data['end_date'],
+                          data['compressed'], request.user)
+        return HttpResponseRedirect(reverse(advanced))
 
+    return render_to_response("retail/advanced.html", {
+            "cache_stats": caching.stats(),
+            "handler_timings": HandlerTiming.summary(datetime.now() - timedelta(days=1)),
+            "export_form": export_form,
+            "export_jobs": jobs[:20],
+        }, context_instance=RequestContext(request))
+
+@login_required
+def export_download(request, job_id):
+    job = get_object_or_404(ExportJob, id=job_id, status=ExportJob.DONE)
+    if not request.user.is_staff and job.organization != request.user.get_profile().organization:
+        return HttpResponse(status=550)
+    try:
+        f = open(job.path, "rb")
+    except IOError:
+        raise Http404
+    response = HttpResponse(FileWrapper(f), mimetype=job.compressed and 'application/x-gzip' or 'text/csv')
+    response['Content-Disposition'] = 'attachment; filename=%s' % job.file_name
+    response['Content-Length'] = os.path.getsize(job.path)
+    return response
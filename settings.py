@@ -42,6 +42,47 @@ INSTALLED_BACKENDS = {
 }
 
 
+# the dashboards cache their figures, and the sms handlers invalidate
+# them when sales or stock change. the router runs in its own process,
+# so the cache must be shared with the web server: the file based cache
+# works out of the box, and the local memory cache is only suitable when
+# both run in one process (eg. the tests).
+# see: http://docs.djangoproject.com/en/dev/topics/cache/
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": "/var/tmp/pikwa_cache",
+    }
+    #"default": {
+    #    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    #},
+}
+
+
+# large sales exports are written to files in this directory by the
+# run_exports command, and a repeat request for the same export within
+# RETAIL_EXPORT_TTL seconds reuses the existing file.
+RETAIL_EXPORT_DIR = "/var/tmp/pikwa_exports"
+RETAIL_EXPORT_TTL = 60 * 60
+
+# /retail/sales/export/ streams the sales of at most this many days in
+# the response. Longer or open ended exports are queued as export jobs.
+RETAIL_SYNC_EXPORT_DAYS = 31
+
+# an export or import still running this many seconds after it started
+# is taken to have lost its worker: exports are queued again, and
+# imports marked as failed.
+RETAIL_JOB_STALE_AFTER = 60 * 60
+
+# the sales feed's cursor stays this many seconds behind the newest
+# changes, so it can't pass a sale whose transaction hasn't committed.
+RETAIL_FEED_LAG = 60
+
+# uploaded sales imports, and the rows of each that were rejected, are
+# kept in this directory until run_imports purges them.
+RETAIL_IMPORT_DIR = "/var/tmp/pikwa_imports"
+
+
 # to help you get started quickly, many django/rapidsms apps are enabled
 # by default. you may wish to remove some and/or add your own.
 INSTALLED_APPS = [
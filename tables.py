@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
+from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.db.models import Sum
+from django.db import connection
+from django.db.models import Sum, Q
 from djtables import Table, Column
-from retail.models import Sale
+from rapidsms.models import Contact, Connection
+from retail.models import Sale, SaleRollup
+from datetime import datetime
 import locale
 
 locale.setlocale(locale.LC_ALL, '')
@@ -27,44 +31,149 @@ def _phone(cell):
 def _seller_alias(cell):
     return cell.object.seller.alias
 
+def _sale_cursor(sale):
+    return "%s|%s" % (sale.purchase_date.strftime("%Y-%m-%d %H:%M:%S.%f"), sale.serial)
+
+def _parse_sale_cursor(cursor):
+    try:
+        date, serial = cursor.split("|", 1)
+        return datetime.strptime(date, "%Y-%m-%d %H:%M:%S.%f"), serial
+    except ValueError:
+        return None
+
 class SaleTable(Table):
-    serial         = Column()
+    """
+    Sales, newest first. Pages are fetched by keyset rather than offset:
+    the next and previous links carry the (purchase_date, serial) of the
+    last or first sale shown, and each page selects the rows beyond it,
+    so deep pages cost the same as the first one. The bound on the date
+    alone is what lets the database start from the cursor in the
+    (purchase_date, serial) index, which it can't do with the OR. Since the order has
+    to be fixed for that, the columns aren't sortable.
+    """
+    serial         = Column(sortable=False)
     purchase_date  = Column(name="Sale Date", value=_sale_date, sortable=False)
-    seller         = Column(value=_seller_alias)
+    seller         = Column(value=_seller_alias, sortable=False)
     customer_name  = Column(name="Customer", value=_customer_name, sortable=False)
     pri_phone      = Column(name="Phone", value=_phone, sortable=False)
     purchase_price = Column(name="Price", value=_price, sortable=False)
-    region         = Column(value=_region)
-    description    = Column()
+    region         = Column(value=_region, sortable=False)
+    description    = Column(sortable=False)
 
     class Meta:
         order_by = '-purchase_date'
+        template = 'retail/sale_table.html'
+
+    @property
+    def object_list(self):
+        return self._object_list.select_related('seller').order_by('-purchase_date', '-serial')
+
+    def _cursor_param(self, name):
+        if self._request is None:
+            return None
+        return _parse_sale_cursor(self._request.GET.get(self._meta.prefix + name, ""))
+
+    def _load_page(self):
+        if hasattr(self, "_page"):
+            return self._page
+        per_page = self._meta.per_page
+        after = self._cursor_param("after")
+        before = self._cursor_param("before")
+        sales = self.object_list
+        if before is not None:
+            #walk back from the first sale of the next page, then flip
+            #the rows back into display order
+            date, serial = before
+            older = sales.reverse().filter(purchase_date__gte=date)\
+                .filter(Q(purchase_date__gt=date) | Q(serial__gt=serial))
+            page = list(older[:per_page + 1])
+            self.has_previous = len(page) > per_page
+            self.has_next = True
+            page = page[:per_page]
+            page.reverse()
+        else:
+            if after is not None:
+                date, serial = after
+                sales = sales.filter(purchase_date__lte=date)\
+                    .filter(Q(purchase_date__lt=date) | Q(serial__lt=serial))
+            page = list(sales[:per_page + 1])
+            self.has_next = len(page) > per_page
+            self.has_previous = after is not None
+            page = page[:per_page]
+        self._page = page
+        return page
+
+    @property
+    def rows(self):
+        return map(
+            lambda o: self._meta.row_class(self, o),
+            self._load_page())
+
+    def first_url(self):
+        return self.get_url(after="", before="")
+
+    def next_url(self):
+        page = self._load_page()
+        if self.has_next and page:
+            return self.get_url(after=_sale_cursor(page[-1]), before="")
+
+    def previous_url(self):
+        page = self._load_page()
+        if self.has_previous and page:
+            return self.get_url(before=_sale_cursor(page[0]), after="")
 
 def _revenue(cell):
     return locale.format("%d", cell.object.cached_revenue, grouping=True)
 
 def _sale_count(cell):
-    return Sale.objects.filter(seller=cell.object).count()
+    return cell.object.sale_count or 0
 
 def _phone(cell):
-    try:
-        return cell.object.default_connection.identity
-    except:
-        return ""
+    return cell.object.phone or ""
 
 def _last_sale(cell):
-    try:
-        return Sale.objects.filter(seller=cell.object).latest('purchase_date').purchase_date.date()
-    except:
+    if not cell.object.sale_count:
         return "Never"
+    last_sale = cell.object.last_sale
+    #sqlite hands back aggregated dates as strings
+    if isinstance(last_sale, basestring):
+        last_sale = datetime.strptime(last_sale[:10], "%Y-%m-%d").date()
+    return last_sale
+
+def with_performance(contacts):
+    """
+    Annotate ``contacts`` with the sale count, last sale day and primary
+    phone number shown by PerformanceTable, so the whole page of sellers
+    is fetched in one query. The totals come from the sale rollups, and
+    the phone is the identity of the first connection, as returned by
+    Contact.default_connection.
+    """
+    qn = connection.ops.quote_name
+    conn_table = Connection._meta.db_table
+    phone_sql = "SELECT %s FROM %s WHERE %s.%s = %s.%s ORDER BY %s LIMIT 1" % (
+        qn('identity'), qn(conn_table),
+        qn(conn_table), qn(Connection._meta.get_field('contact').column),
+        qn(Contact._meta.db_table), qn(Contact._meta.pk.column),
+        qn('id'))
+    #rollups of days whose sales were all canceled are kept at 0, and
+    #don't count as a last sale
+    rollup_table = SaleRollup._meta.db_table
+    last_sale_sql = "SELECT MAX(%s) FROM %s WHERE %s.%s = %s.%s AND %s > 0" % (
+        qn('day'), qn(rollup_table),
+        qn(rollup_table), qn(SaleRollup._meta.get_field('seller').column),
+        qn(Contact._meta.db_table), qn(Contact._meta.pk.column),
+        qn('sale_count'))
+    return contacts.annotate(sale_count=Sum('salerollup__sale_count'))\
+        .extra(select={'phone': phone_sql, 'last_sale': last_sale_sql})
 
 class PerformanceTable(Table):
     alias          = Column()
     name           = Column()
-    cached_revenue = Column(name="Revenue (Tsh)", value=_revenue, sortable=False)
-    sale_count     = Column(name="Sales", value=_sale_count, sortable=False)
+    cached_revenue = Column(name="Revenue (Tsh)", value=_revenue)
+    sale_count     = Column(name="Sales", value=_sale_count)
     phone          = Column(name="Phone", value=_phone, sortable=False)
-    last_sale      = Column(name="Last Sale", value=_last_sale, sortable=False)
+    last_sale      = Column(name="Last Sale", value=_last_sale)
 
     class Meta:
         order_by = "-cached_revenue"
+        per_page = getattr(settings, "RETAIL_TOP_SELLERS", 20)